@@ -0,0 +1,96 @@
+#!/usr/bin/env python2
+'''
+Micro-benchmark of the Images name index.
+
+Builds an Images dictionary from synthetic image and digest filenames
+and times one daemon poll's worth of queries (latest() and images() for
+every name) against the previous implementation, which scanned every
+image for each query.
+
+    PYTHONPATH=. python2 benchmarks/images_index.py [num_files] [num_names]
+'''
+
+from butter.vmcache import image
+import logging
+import re
+import sys
+import time
+
+REGEX = re.compile(r'^(?P<image>(?P<name>[^_]+)_(?P<version>\d+(-\d+)?)'
+                   r'\.raw\.xz)(\.(?P<digest>sha(\d+)|md5)(sum)?)?$')
+
+class SyntheticFilesystem(object):
+    '''
+    A flat filesystem holding only the given filenames.
+    '''
+    def __init__(self, filenames):
+        self.filenames = filenames
+
+    def abspath(self, path):
+        return 'synthetic:' + path
+
+    def walk(self, unused_path, unused_topdown=True):
+        yield '/', [], self.filenames
+
+def synthetic_filenames(num_files, num_names):
+    '''
+    Return num_files image and digest filenames spread over num_names.
+    '''
+    filenames = []
+    versions = num_files // 2 // num_names
+    for n in range(num_names):
+        for v in range(versions):
+            img = 'distro{}_{}-{}.raw.xz'.format(n, 20120101 + v % 28, v)
+            filenames.append(img)
+            filenames.append(img + '.sha256')
+    return filenames
+
+def linear_latest(images, name):
+    '''
+    The previous Images.latest(): scan every image.
+    '''
+    latest = None
+    for img in images.values():
+        if img.name == name and (latest is None or latest < img):
+            latest = img
+    return latest
+
+def linear_images(images, name):
+    '''
+    The previous Images.images(): scan and sort.
+    '''
+    return sorted(img for img in images.values() if img.name == name)
+
+def timed(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+def main(argv):
+    num_files = int(argv[1]) if len(argv) > 1 else 100000
+    num_names = int(argv[2]) if len(argv) > 2 else 100
+    logging.disable(logging.CRITICAL)
+    fs = SyntheticFilesystem(synthetic_filenames(num_files, num_names))
+
+    secs, images = timed(lambda: image.Images(fs, REGEX))
+    print 'scan {} files into {} images: {:.3f} secs'.format(
+            len(fs.filenames), len(images), secs)
+
+    names = sorted(images.names())
+    def indexed():
+        return [(images.latest(name), images.images(name)) for name in names]
+    def linear():
+        return [(linear_latest(images, name), linear_images(images, name))
+                for name in names]
+
+    # The first indexed poll includes building the index
+    index_secs, indexed_result = timed(indexed)
+    linear_secs, linear_result = timed(linear)
+    assert indexed_result == linear_result
+    print 'indexed poll of {} names: {:.3f} secs'.format(len(names),
+                                                         index_secs)
+    print 'linear poll of {} names:  {:.3f} secs ({:.0f}x slower)'.format(
+            len(names), linear_secs, linear_secs / max(index_secs, 1e-9))
+
+if __name__ == '__main__':
+    main(sys.argv)
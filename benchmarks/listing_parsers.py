@@ -0,0 +1,112 @@
+#!/usr/bin/env python2
+'''
+Micro-benchmark of the directory listing parsers.
+
+Parses a synthetic listing of num_files images and digest files in each
+format that butter.listing supports and compares them with the previous
+HttpFilesystem.html_to_filenames, which removed duplicates with a list
+lookup per link.
+
+    PYTHONPATH=. python2 benchmarks/listing_parsers.py [num_files]
+'''
+
+from HTMLParser import HTMLParser
+from StringIO import StringIO
+from butter import listing
+from urllib import quote, unquote
+from urlparse import urlsplit
+import json
+import sys
+import time
+
+def synthetic_filenames(num_files):
+    '''
+    Return num_files image and digest filenames.
+    '''
+    filenames = []
+    for i in range(num_files // 2):
+        img = 'distro{}_{}.raw.xz'.format(i % 100, 20120101 + i)
+        filenames.append(img)
+        filenames.append(img + '.sha256')
+    return filenames
+
+def apache_fancy(filenames):
+    '''
+    An Apache mod_autoindex table listing.
+    '''
+    rows = ''.join('<tr><td valign="top"><img src="/icons/unknown.gif" '
+                   'alt="[   ]"></td><td><a href="{0}">{1}</a></td>'
+                   '<td align="right">2012-01-01 00:00  </td>'
+                   '<td align="right">1.2G</td><td>&nbsp;</td></tr>\n'
+                    .format(quote(name), name) for name in filenames)
+    return ('<html><head><title>Index of /varch</title></head><body>\n'
+            '<h1>Index of /varch</h1>\n<table>\n<tr><th><a href="?C=N;O=D">'
+            'Name</a></th></tr>\n<tr><td><a href="/">Parent Directory</a>'
+            '</td></tr>\n' + rows + '</table>\n</body></html>\n')
+
+def apache_plain(filenames):
+    '''
+    An Apache mod_autoindex F=0 listing.
+    '''
+    return ('<html><body>\n<h1>Index of /varch</h1>\n<ul><li><a href="/"> '
+            'Parent Directory</a></li>\n' +
+            ''.join('<li><a href="{0}"> {1}</a></li>\n'
+                    .format(quote(name), name) for name in filenames) +
+            '</ul>\n</body></html>\n')
+
+def nginx_json(filenames):
+    '''
+    An nginx autoindex_format json listing.
+    '''
+    return json.dumps([{'name': name, 'type': 'file',
+                        'mtime': 'Sun, 01 Jan 2012 00:00:00 GMT',
+                        'size': 1234567890} for name in filenames])
+
+def previous_html_to_filenames(html):
+    '''
+    The previous HttpFilesystem.html_to_filenames().
+    '''
+    class HrefParser(HTMLParser):
+        def __init__(self):
+            HTMLParser.__init__(self)
+            self.hrefs = []
+        def handle_starttag(self, tag, attrs):
+            if tag == 'a':
+                for unused_name, value in attrs:
+                    parts = urlsplit(value)
+                    if '/' not in parts.path[:-1] and \
+                       not (parts.scheme or
+                            parts.netloc or
+                            parts.query or
+                            parts.fragment):
+                        value = unquote(value)
+                        if value not in self.hrefs:
+                            self.hrefs.append(value)
+    parser = HrefParser()
+    parser.feed(html)
+    return parser.hrefs
+
+def timed(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+def main(argv):
+    num_files = int(argv[1]) if len(argv) > 1 else 20000
+    filenames = synthetic_filenames(num_files)
+    fancy = apache_fancy(filenames)
+    secs, previous = timed(lambda: previous_html_to_filenames(fancy))
+    # The previous parser also listed the parent directory link
+    assert previous[1:] == filenames
+    print 'previous html parser, apache fancy:   {:.3f} secs'.format(secs)
+    for label, body in [('apache fancy', fancy),
+                        ('apache F=0', apache_plain(filenames)),
+                        ('nginx json', nginx_json(filenames))]:
+        secs, result = timed(lambda: listing.parse(StringIO(body)))
+        assert result == filenames
+        print '{:13} {:24} {:.3f} secs ({:.0f} KB)'.format(
+                label + ':', listing.get_parser(None, body).__class__.__name__,
+                secs, len(body) / 1024.0)
+
+if __name__ == '__main__':
+    main(sys.argv)
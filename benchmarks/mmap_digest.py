@@ -0,0 +1,111 @@
+#!/usr/bin/env python2
+'''
+Benchmark of image digest computation.
+
+Writes a file of each size and computes its digest with the fp.read()
+loop (with an 8 KiB and the default 1 MiB buffer) and with
+LocalFilesystem.mapped_views(), which Image._compute_digest uses for
+local files if mmap_digests is enabled.
+
+    PYTHONPATH=. python2 benchmarks/mmap_digest.py [--sizes 1 5 20] \\
+        [--dir /var/tmp] [--cold]
+
+Sizes are in GiB.  Sizes larger than RAM are read from disk whatever
+the method; --cold drops the page cache before each run (needs root)
+so smaller sizes are too.
+'''
+
+from butter import vfs
+from butter.vmcache import image
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+CHUNK_SIZE = 1024 * 1024
+
+def make_file(path, size):
+    '''
+    Write size bytes that don't compress or deduplicate.
+    '''
+    block = bytearray(os.urandom(CHUNK_SIZE))
+    with open(path, 'wb') as fp:
+        remaining = size
+        while remaining > 0:
+            block[:16] = '{:016x}'.format(remaining)
+            fp.write(block[:min(remaining, CHUNK_SIZE)])
+            remaining -= CHUNK_SIZE
+
+def read_loop(bufsize):
+    '''
+    Return the previous digest loop with the given buffer size.
+    '''
+    def digest(fs, path, algorithm):
+        digestor = hashlib.new(algorithm)
+        with fs.open(path, 'rb') as fp:
+            buf = fp.read(bufsize)
+            while buf:
+                digestor.update(buf)
+                buf = fp.read(bufsize)
+        return digestor.hexdigest()
+    return digest
+
+def mapped(fs, path, algorithm):
+    '''
+    The digest as Image._compute_digest computes it with mmap_digests.
+    '''
+    fs.use_mmap = True
+    try:
+        return image.Image(None)._compute_digest(fs, path, algorithm)
+    finally:
+        fs.use_mmap = False
+
+def drop_caches():
+    '''
+    Drop the page cache so the file is read from disk.
+    '''
+    os.system('sync')
+    with open('/proc/sys/vm/drop_caches', 'w') as fp:
+        fp.write('3\n')
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark digests.')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 5, 20],
+                        help='file sizes in GiB (default: %(default)s)')
+    parser.add_argument('--dir', default=None,
+                        help='directory of the files (default: $TMPDIR)')
+    parser.add_argument('--algorithm', default='sha256',
+                        help='digest algorithm (default: %(default)s)')
+    parser.add_argument('--cold', action='store_true',
+                        help='drop the page cache before each run')
+    args = parser.parse_args(argv[1:])
+
+    methods = [('read 8 KiB', read_loop(8192)),
+               ('read 1 MiB', read_loop(image.BUFSIZE)),
+               ('mmap', mapped)]
+    tmpdir = tempfile.mkdtemp(prefix='mmap_digest.', dir=args.dir)
+    fs = vfs.get_filesystem(tmpdir)
+    try:
+        for gib in args.sizes:
+            size = int(gib * 1024 ** 3)
+            make_file(os.path.join(tmpdir, 'image'), size)
+            digests = set()
+            for label, func in methods:
+                if args.cold:
+                    drop_caches()
+                start = time.time()
+                digests.add(func(fs, '/image', args.algorithm))
+                secs = time.time() - start
+                print '{:6.1f} GiB  {:10}  {:7.2f} secs  {:7.1f} MB/s'.format(
+                        gib, label, secs, size / secs / 1e6)
+                sys.stdout.flush()
+            assert len(digests) == 1
+            os.remove(os.path.join(tmpdir, 'image'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python2
+'''
+Benchmark of peer-to-peer image distribution on one machine.
+
+Starts an origin PeerServer, standing in for images_url, whose upload
+rate is limited like a single salt master's, and a number of peers
+that each run a PeerServer and download the same new image at the same
+time, in separate processes.  Every peer first downloads the image
+straight from the origin, and then again through a Swarm.  The
+benchmark reports the wall time and the bytes the origin uploaded for
+each mode.
+
+    PYTHONPATH=. python2 benchmarks/peer_swarm.py [peers] [image_mb] [origin_mb_per_sec]
+'''
+
+from butter import vfs
+from butter.throttle import TokenBucket
+from butter.vmcache import image
+from butter.vmcache.peer import PeerServer, Swarm
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+REGEX = re.compile(r'^(?P<image>(?P<name>[^_]+)_(?P<version>\d+)\.raw)'
+                   r'(\.(?P<digest>sha(\d+)|md5)(sum)?)?$')
+CHUNK_SIZE = 1024 * 1024
+
+def make_image(origin_dir, size):
+    '''
+    Write a random image and its digest file.
+    '''
+    path = os.path.join(origin_dir, 'vm_20120102.raw')
+    digestor = hashlib.sha256()
+    with open(path, 'wb') as fp:
+        for unused_i in range(size // CHUNK_SIZE):
+            buf = os.urandom(CHUNK_SIZE)
+            digestor.update(buf)
+            fp.write(buf)
+    with open(path + '.sha256', 'w') as fp:
+        fp.write('{}  vm_20120102.raw\n'.format(digestor.hexdigest()))
+
+def run_peer(server, peer_urls, origin_url, dest_dir, use_swarm, start,
+             done, results):
+    '''
+    Download the image like a vmcache daemon, then keep serving it
+    until every peer is done.  Runs in its own process.
+    '''
+    swarm = Swarm(peer_urls, CHUNK_SIZE, 4) if use_swarm else None
+    server.swarm = swarm
+    server.start()
+    remote = image.Images(vfs.get_filesystem(origin_url), REGEX)
+    start.wait()
+    begin = time.time()
+    img = remote.latest('vm').download(vfs.get_filesystem(dest_dir),
+                                       swarm=swarm)
+    results.put((img is not None, time.time() - begin))
+    done.wait()
+    server.stop()
+
+def run(num_peers, size, origin_rate, use_swarm, tmpdir):
+    '''
+    Distribute the image to num_peers peers.
+    Returns (wall secs, bytes uploaded by the origin, all ok).
+    '''
+    origin_fs = vfs.get_filesystem(os.path.join(tmpdir, 'origin'))
+    origin_fs.read_bucket = TokenBucket(origin_rate)
+    origin = PeerServer(origin_fs, port=0, address='127.0.0.1')
+    origin.start()
+    origin_url = 'http://127.0.0.1:{}/'.format(origin.port)
+
+    servers = [PeerServer(None, port=0, address='127.0.0.1')
+               for unused_i in range(num_peers)]
+    peer_urls = ['http://127.0.0.1:{}/'.format(server.port)
+                 for server in servers]
+    start = multiprocessing.Event()
+    done = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    procs = []
+    for i, server in enumerate(servers):
+        dest_dir = os.path.join(tmpdir, 'peer{}-{}'.format(i, use_swarm))
+        os.mkdir(dest_dir)
+        server.fs = vfs.get_filesystem(dest_dir)
+        proc = multiprocessing.Process(target=run_peer,
+                                       args=(server, peer_urls, origin_url,
+                                             dest_dir, use_swarm, start,
+                                             done, results))
+        proc.start()
+        procs.append(proc)
+    for server in servers:
+        server.server_close()
+
+    time.sleep(1)
+    origin_fs.read_bucket.counters(reset=True)
+    begin = time.time()
+    start.set()
+    outcomes = [results.get() for unused_proc in procs]
+    elapsed = time.time() - begin
+    done.set()
+    for proc in procs:
+        proc.join()
+    origin.stop()
+    uploaded, unused_wait = origin_fs.read_bucket.counters()
+    return elapsed, uploaded, all(ok for ok, unused_secs in outcomes)
+
+def main(argv):
+    num_peers = int(argv[1]) if len(argv) > 1 else 6
+    size = int(argv[2]) if len(argv) > 2 else 64
+    origin_rate = float(argv[3]) if len(argv) > 3 else 32
+    size *= 1024 * 1024
+    origin_rate *= 1024 * 1024
+    logging.basicConfig(level=logging.WARNING)
+    tmpdir = tempfile.mkdtemp(prefix='peer_swarm.')
+    try:
+        os.mkdir(os.path.join(tmpdir, 'origin'))
+        make_image(os.path.join(tmpdir, 'origin'), size)
+        print '{} peers, {} MiB image, origin limited to {:.0f} MiB/s'.format(
+                num_peers, size // 1024 // 1024, origin_rate / 1024 / 1024)
+        for use_swarm in [False, True]:
+            elapsed, uploaded, ok = run(num_peers, size, origin_rate,
+                                        use_swarm, tmpdir)
+            print '{:6}: {:6.1f} secs, origin uploaded {:.2f}x the image{}' \
+                    .format('swarm' if use_swarm else 'origin', elapsed,
+                            float(uploaded) / size,
+                            '' if ok else ' (DOWNLOAD FAILED)')
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,408 @@
+#!/usr/bin/env python2
+'''
+Benchmark and self-check of S3Filesystem against an in-process S3
+stand-in.
+
+The stand-in serves a bucket from memory and implements the parts of
+the S3 API that S3Filesystem uses: ListObjectsV2 pages, ranged and
+conditional GETs, PUTs, server-side copies, multipart uploads and
+DELETEs.  It checks the signature of every request.  The suite times:
+
+    list      a listing of --objects objects, --max-keys per page
+    read      a read of a --size MiB object in parallel ranged GETs
+    upload    a multipart upload of a --size MiB object
+    rename    a server-side copy of that object and the delete of the
+              original
+
+and fails if a result differs from what the stand-in holds.  The
+results are printed as one JSON document on stdout (a summary goes to
+stderr), e.g.:
+
+    PYTHONPATH=. python2 benchmarks/s3_suite.py --size 64 --threads 4
+'''
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from butter import vfs
+from urlparse import parse_qsl, urlsplit
+from xml.sax.saxutils import escape
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+import urllib
+
+BUCKET = 'images'
+ACCESS_KEY = 'AKIDEXAMPLE'
+SECRET_KEY = 'secret'
+REGION = 'us-east-1'
+NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+CHUNK_SIZE = 1024 * 1024
+
+class S3StandIn(ThreadingMixIn, HTTPServer):
+    '''
+    Serves one bucket of objects held in memory.
+    '''
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _S3Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def reset_counts(self):
+        '''
+        Forget the requests seen so far.
+        '''
+        with self.lock:
+            self.requests = []
+            self.max_active = self.active
+
+class _S3Handler(BaseHTTPRequestHandler):
+    '''
+    Handle an S3 request for the server's bucket.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_HEAD(self):
+        self._handle(self._get)
+
+    def do_GET(self):
+        self._handle(self._get)
+
+    def do_PUT(self):
+        self._handle(self._put)
+
+    def do_POST(self):
+        self._handle(self._post)
+
+    def do_DELETE(self):
+        self._handle(self._delete)
+
+    def _handle(self, method):
+        '''
+        Check the request's signature and call method(key, query, body).
+        '''
+        parts = urlsplit(self.path)
+        path = urllib.unquote(parts.path)
+        query = dict(parse_qsl(parts.query, keep_blank_values=True))
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        bucket, _, key = path.lstrip('/').partition('/')
+        if bucket != BUCKET:
+            return self._error(404, 'NoSuchBucket')
+        if not self._signed(path, query, body):
+            return self._error(403, 'SignatureDoesNotMatch')
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, key, query,
+                                    self.headers.getheader('Range')))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            method(key, query, body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def _signed(self, path, query, body):
+        '''
+        Is the request signed with the stand-in's credentials?
+        '''
+        auth = self.headers.getheader('Authorization') or ''
+        match = re.search('SignedHeaders=([^,]+)', auth)
+        if not match:
+            return False
+        headers = dict((name, self.headers.getheader(name))
+                       for name in match.group(1).split(';'))
+        if hashlib.sha256(body).hexdigest() != \
+           self.headers.getheader('x-amz-content-sha256'):
+            return False
+        return auth == vfs._sign_v4(self.command, path, query, headers,
+                                    REGION, ACCESS_KEY, SECRET_KEY)
+
+    def _reply(self, code, body='', headers=()):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _error(self, code, error):
+        self._reply(code, '<Error><Code>{}</Code><Message>{}</Message>'
+                          '</Error>'.format(error, error))
+
+    def _get(self, key, query, unused_body):
+        if not key:
+            return self._list(query)
+        data = self.server.objects.get(key)
+        if data is None:
+            return self._error(404, 'NoSuchKey')
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        if self.headers.getheader('If-Match') not in (None, etag):
+            return self._error(412, 'PreconditionFailed')
+        match = re.match(r'bytes=(\d+)-(\d*)$',
+                         self.headers.getheader('Range') or '')
+        if not match:
+            return self._reply(200, data, [('ETag', etag)])
+        start = int(match.group(1))
+        end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+        if start >= len(data):
+            return self._error(416, 'InvalidRange')
+        self._reply(206, data[start:end + 1],
+                    [('ETag', etag),
+                     ('Content-Range', 'bytes {}-{}/{}'.format(start, end,
+                                                               len(data)))])
+
+    def _list(self, query):
+        '''
+        Reply with a ListObjectsV2 page.
+        '''
+        prefix = query.get('prefix', '')
+        delimiter = query.get('delimiter')
+        entries = []
+        for key in sorted(self.server.objects):
+            if not key.startswith(prefix):
+                continue
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                common = prefix + rest.split(delimiter)[0] + delimiter
+                if ('CommonPrefixes', common) not in entries:
+                    entries.append(('CommonPrefixes', common))
+            else:
+                entries.append(('Contents', key))
+        start = int(query.get('continuation-token', 0))
+        end = start + int(query.get('max-keys', 1000))
+        xml = ['<?xml version="1.0"?><ListBucketResult xmlns="{}">'
+               .format(NS)]
+        xml.append('<IsTruncated>{}</IsTruncated>'
+                   .format('true' if end < len(entries) else 'false'))
+        if end < len(entries):
+            xml.append('<NextContinuationToken>{}</NextContinuationToken>'
+                       .format(end))
+        for elem, value in entries[start:end]:
+            tag = 'Key' if elem == 'Contents' else 'Prefix'
+            xml.append('<{0}><{1}>{2}</{1}></{0}>'
+                       .format(elem, tag, escape(value)))
+        xml.append('</ListBucketResult>')
+        self._reply(200, ''.join(xml), [('Content-Type', 'application/xml')])
+
+    def _put(self, key, query, body):
+        source = self.headers.getheader('x-amz-copy-source')
+        if source:
+            unused_bucket, _, source_key = \
+                    urllib.unquote(source).lstrip('/').partition('/')
+            body = self.server.objects.get(source_key)
+            if body is None:
+                return self._error(404, 'NoSuchKey')
+            match = re.match(r'bytes=(\d+)-(\d+)$', self.headers.getheader(
+                    'x-amz-copy-source-range') or '')
+            if match:
+                body = body[int(match.group(1)):int(match.group(2)) + 1]
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if 'uploadId' in query:
+            parts = self.server.uploads.get(query['uploadId'])
+            if parts is None:
+                return self._error(404, 'NoSuchUpload')
+            parts[int(query['partNumber'])] = (etag, body)
+        else:
+            self.server.objects[key] = body
+        if source:
+            return self._reply(200, '<CopyObjectResult><ETag>{}</ETag>'
+                                    '</CopyObjectResult>'.format(escape(etag)))
+        self._reply(200, '', [('ETag', etag)])
+
+    def _post(self, key, query, body):
+        uploads = self.server.uploads
+        if 'uploads' in query:
+            with self.server.lock:
+                upload_id = str(len(uploads) + 1)
+                uploads[upload_id] = {}
+            return self._reply(200, '<InitiateMultipartUploadResult>'
+                                    '<UploadId>{}</UploadId>'
+                                    '</InitiateMultipartUploadResult>'
+                                        .format(upload_id))
+        parts = uploads.pop(query.get('uploadId'), None)
+        if parts is None:
+            return self._error(404, 'NoSuchUpload')
+        listed = re.findall(r'<PartNumber>(\d+)</PartNumber>'
+                            r'<ETag>([^<]*)</ETag>', body)
+        data = []
+        for i, (number, etag) in enumerate(listed):
+            part = parts.get(int(number))
+            if part is None or part[0] != etag.replace('&quot;', '"'):
+                return self._reply(200, '<Error><Code>InvalidPart</Code>'
+                                        '<Message>part {}</Message></Error>'
+                                            .format(number))
+            if i < len(listed) - 1 and len(part[1]) < 5 * 1024 * 1024:
+                return self._reply(200, '<Error><Code>EntityTooSmall</Code>'
+                                        '<Message>part {}</Message></Error>'
+                                            .format(number))
+            data.append(part[1])
+        self.server.objects[key] = ''.join(data)
+        self._reply(200, '<CompleteMultipartUploadResult/>')
+
+    def _delete(self, key, query, unused_body):
+        if 'uploadId' in query:
+            self.server.uploads.pop(query['uploadId'], None)
+        else:
+            self.server.objects.pop(key, None)
+        self._reply(204)
+
+def make_fs(server, args):
+    '''
+    Return an S3Filesystem of the stand-in's bucket.
+    '''
+    fs = vfs.get_filesystem('s3://{}/suite'.format(BUCKET))
+    fs.endpoint_url = server.url
+    fs.region = REGION
+    fs.access_key = ACCESS_KEY
+    fs.secret_key = SECRET_KEY
+    fs.session_token = None
+    fs.part_size = int(args.part_size * 1024 * 1024)
+    fs.threads = args.threads
+    fs.read_ahead = int(args.read_ahead * 1024 * 1024)
+    fs.max_keys = args.max_keys
+    return fs
+
+def make_data(size):
+    '''
+    Return size bytes whose chunks all differ.
+    '''
+    block = bytearray(os.urandom(CHUNK_SIZE))
+    chunks = []
+    for offset in range(0, size, CHUNK_SIZE):
+        block[:16] = '{:016x}'.format(offset)
+        chunks.append(bytes(block[:min(CHUNK_SIZE, size - offset)]))
+    return ''.join(chunks)
+
+def bench_list(server, fs, args):
+    '''
+    List a directory of args.objects objects.
+    '''
+    expected = ['obj{:05d}'.format(i) for i in range(args.objects)]
+    for name in expected:
+        server.objects['suite/list/' + name] = name
+    server.reset_counts()
+    start = time.time()
+    filenames = fs.list('/list')
+    secs = time.time() - start
+    if sorted(filenames) != expected:
+        raise RuntimeError('listed {} of {} objects'
+                            .format(len(filenames), len(expected)))
+    return {'objects': len(filenames), 'pages': len(server.requests),
+            'secs': secs}
+
+def bench_read(server, fs, data):
+    '''
+    Read an object and compare it with data.
+    '''
+    server.objects['suite/image.raw'] = data
+    server.reset_counts()
+    digestor = hashlib.sha256()
+    start = time.time()
+    with fs.open('/image.raw', 'rb') as fp:
+        buf = fp.read(CHUNK_SIZE)
+        while buf:
+            digestor.update(buf)
+            buf = fp.read(CHUNK_SIZE)
+    secs = time.time() - start
+    if digestor.hexdigest() != hashlib.sha256(data).hexdigest():
+        raise RuntimeError('read object differs')
+    return {'bytes': len(data), 'gets': len(server.requests),
+            'max_parallel_gets': server.max_active, 'secs': secs,
+            'mb_per_sec': len(data) / secs / 1e6 if secs else 0.0}
+
+def bench_upload(server, fs, data):
+    '''
+    Write an object and compare what the stand-in stored with data.
+    '''
+    server.reset_counts()
+    start = time.time()
+    with fs.open('/upload.raw', 'wb') as fp:
+        for offset in range(0, len(data), CHUNK_SIZE):
+            fp.write(data[offset:offset + CHUNK_SIZE])
+    secs = time.time() - start
+    if server.objects.get('suite/upload.raw') != data:
+        raise RuntimeError('uploaded object differs')
+    parts = len([request for request in server.requests
+                 if 'partNumber' in request[2]])
+    return {'bytes': len(data), 'parts': parts, 'secs': secs,
+            'mb_per_sec': len(data) / secs / 1e6 if secs else 0.0}
+
+def bench_rename(server, fs, data):
+    '''
+    Rename the uploaded object.
+    '''
+    start = time.time()
+    fs.rename('/upload.raw', '/renamed.raw')
+    secs = time.time() - start
+    if 'suite/upload.raw' in server.objects or \
+       server.objects.get('suite/renamed.raw') != data:
+        raise RuntimeError('renamed object differs')
+    return {'bytes': len(data), 'secs': secs}
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            description='Benchmark and check S3Filesystem.')
+    parser.add_argument('--objects', type=int, default=2500,
+                        help='objects listed (default: %(default)s)')
+    parser.add_argument('--max-keys', type=int, default=1000,
+                        help='objects per listing page (default: %(default)s)')
+    parser.add_argument('--size', type=float, default=64,
+                        help='object size in MiB (default: %(default)s)')
+    parser.add_argument('--part-size', type=float, default=8,
+                        help='part size in MiB (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='parallel requests (default: %(default)s)')
+    parser.add_argument('--read-ahead', type=float, default=32,
+                        help='read-ahead in MiB (default: %(default)s)')
+    args = parser.parse_args(argv[1:])
+
+    server = S3StandIn()
+    try:
+        fs = make_fs(server, args)
+        data = make_data(int(args.size * 1024 * 1024))
+        results = {}
+        for name, func, func_args in [('list', bench_list, (args,)),
+                                      ('read', bench_read, (data,)),
+                                      ('upload', bench_upload, (data,)),
+                                      ('rename', bench_rename, (data,))]:
+            try:
+                results[name] = func(server, fs, *func_args)
+            except Exception, ex:
+                results[name] = {'error': repr(ex)}
+            sys.stderr.write('{:8} {}\n'.format(name, ', '.join(
+                    '{}={}'.format(key, round(value, 3)
+                                   if isinstance(value, float) else value)
+                    for key, value in sorted(results[name].items()))))
+    finally:
+        server.stop()
+    json.dump({'params': vars(args), 'results': results}, sys.stdout,
+              indent=2, separators=(',', ': '), sort_keys=True)
+    sys.stdout.write('\n')
+    return 1 if any('error' in result for result in results.values()) else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
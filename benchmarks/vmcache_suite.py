@@ -0,0 +1,263 @@
+#!/usr/bin/env python2
+'''
+Benchmark suite for vmcache.
+
+Writes a synthetic tree of images and digest files, serves it from a
+local HTTP server, and times:
+
+    scan      Images scanning of the HTTP tree (listing every directory)
+    download  Image.download of the latest version of every image name
+    daemon    one full VmCacheDaemon.run iteration into an empty
+              images_dir, i.e. scan, download, and prune
+
+Each benchmark runs in its own process so its peak RSS can be reported.
+The results are printed as one JSON document on stdout (a summary goes
+to stderr) so they can be compared between commits, e.g.:
+
+    PYTHONPATH=. python2 benchmarks/vmcache_suite.py --names 20 \\
+        --versions 3 --size 16 --depth 2 --fanout 4 > results.json
+'''
+
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from butter import vfs
+from butter.vmcache import image
+from butter.vmcache.config import Config
+from butter.vmcache.server import VmCacheDaemon
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import posixpath
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import yaml
+
+IMAGE_REGEX = r'(?P<name>[^_]+)_(?P<version>\d+)\.raw'
+REGEX = re.compile(r'^(?P<image>{})(\.(?P<digest>sha(\d+)|md5)(sum)?)?$'
+                   .format(IMAGE_REGEX))
+CHUNK_SIZE = 1024 * 1024
+
+class TreeServer(ThreadingMixIn, HTTPServer):
+    '''
+    Serves a directory tree with HTML listings, like a mirror.
+    '''
+    daemon_threads = True
+
+    def __init__(self, root):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _TreeHandler)
+        self.root = root
+        self.url = 'http://127.0.0.1:{}/'.format(self.server_address[1])
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class _TreeHandler(SimpleHTTPRequestHandler):
+    '''
+    Serve the server's root instead of the working directory.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def translate_path(self, path):
+        path = posixpath.normpath(urllib.unquote(path.split('?')[0]))
+        return os.path.join(self.server.root, path.lstrip('/'))
+
+    def send_response(self, code, message=None):
+        SimpleHTTPRequestHandler.send_response(self, code, message)
+        if code == 301:
+            # The directory redirect has no body, but keep-alive clients
+            # need to be told
+            self.send_header('Content-Length', '0')
+
+    def log_message(self, fmt, *args):
+        pass
+
+def make_tree(root, names, versions, size, depth, fanout):
+    '''
+    Write versions images of size bytes for each of names image names,
+    spread over a directory tree depth levels deep with fanout
+    subdirectories per level.  Returns the number of files written.
+    '''
+    block = bytearray(os.urandom(CHUNK_SIZE))
+    nfiles = 0
+    for n in range(names):
+        parts = ['d{}'.format(n // fanout ** level % fanout)
+                 for level in range(depth)]
+        dirname = os.path.join(root, *parts)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        for v in range(versions):
+            filename = 'img{}_{}.raw'.format(n, 20120101 + v)
+            digestor = hashlib.sha256()
+            with open(os.path.join(dirname, filename), 'wb') as fp:
+                remaining = size
+                while remaining > 0:
+                    # Make every chunk of every image different
+                    block[:16] = '{:08x}{:08x}'.format(nfiles, remaining)
+                    buf = bytes(block[:min(remaining, CHUNK_SIZE)])
+                    digestor.update(buf)
+                    fp.write(buf)
+                    remaining -= len(buf)
+            with open(os.path.join(dirname, filename + '.sha256'), 'w') as fp:
+                fp.write('{}  {}\n'.format(digestor.hexdigest(), filename))
+            nfiles += 2
+    return nfiles
+
+def bench_scan(url, repeat):
+    '''
+    Scan the HTTP tree repeat times with a new filesystem (and so an
+    empty listing cache) each time.
+    '''
+    times = []
+    for unused_i in range(repeat):
+        start = time.time()
+        images = image.Images(vfs.get_filesystem(url), REGEX)
+        times.append(time.time() - start)
+    return {'images': len(images),
+            'secs': min(times),
+            'mean_secs': sum(times) / len(times)}
+
+def bench_download(url, tmpdir):
+    '''
+    Download the latest version of every image name.
+    '''
+    remote = image.Images(vfs.get_filesystem(url), REGEX)
+    dest_dir = tempfile.mkdtemp(dir=tmpdir)
+    dest_fs = vfs.get_filesystem(dest_dir)
+    nbytes = 0
+    start = time.time()
+    for name in sorted(remote.names()):
+        img = remote.latest(name).download(dest_fs)
+        if img is None:
+            raise RuntimeError('download of {} failed'.format(name))
+        nbytes += dest_fs.size(img.image_path)
+    secs = time.time() - start
+    return {'images': len(remote.names()), 'bytes': nbytes, 'secs': secs,
+            'mb_per_sec': nbytes / secs / 1e6 if secs else 0.0}
+
+class _OnePoll(VmCacheDaemon):
+    '''
+    A daemon that stops instead of sleeping after its first poll.
+    '''
+    def sleep(self, unused_secs):
+        self.shutdown = True
+        return False
+
+def bench_daemon(url, tmpdir, parallel):
+    '''
+    Run one VmCacheDaemon poll into an empty images_dir.
+    '''
+    images_dir = tempfile.mkdtemp(dir=tmpdir)
+    path = os.path.join(tmpdir, 'vmcache.conf')
+    with open(path, 'w') as fp:
+        yaml.safe_dump({'images_url': url,
+                        'images_dir': images_dir,
+                        'image_regex': IMAGE_REGEX,
+                        'max_parallel_downloads': parallel}, fp)
+    daemon = _OnePoll(Config(path), None)
+    if not daemon.configure():
+        raise RuntimeError('invalid benchmark config')
+    start = time.time()
+    daemon.run()
+    secs = time.time() - start
+    local = image.Images(vfs.get_filesystem(images_dir), REGEX)
+    nbytes = sum(os.path.getsize(os.path.join(images_dir,
+                                              img.image_path.lstrip('/')))
+                 for img in local.values())
+    return {'images': len(local), 'bytes': nbytes, 'secs': secs,
+            'mb_per_sec': nbytes / secs / 1e6 if secs else 0.0}
+
+def _run_child(func, args, queue):
+    '''
+    Run a benchmark and put its result with the peak RSS on the queue.
+    '''
+    logging.disable(logging.CRITICAL)
+    try:
+        result = func(*args)
+    except Exception, ex:
+        result = {'error': repr(ex)}
+    result['peak_rss_kb'] = resource.getrusage(
+                                resource.RUSAGE_SELF).ru_maxrss
+    queue.put(result)
+
+def run(func, *args):
+    '''
+    Run a benchmark in a child process and return its result.
+    '''
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_run_child,
+                                   args=(func, args, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark vmcache.')
+    parser.add_argument('--names', type=int, default=10,
+                        help='image names (default: %(default)s)')
+    parser.add_argument('--versions', type=int, default=2,
+                        help='versions of each image (default: %(default)s)')
+    parser.add_argument('--size', type=float, default=16,
+                        help='MiB per image (default: %(default)s)')
+    parser.add_argument('--depth', type=int, default=1,
+                        help='directory depth (default: %(default)s)')
+    parser.add_argument('--fanout', type=int, default=4,
+                        help='subdirectories per level (default: '
+                             '%(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='scan repetitions (default: %(default)s)')
+    parser.add_argument('--parallel', type=int, default=1,
+                        help='daemon max_parallel_downloads (default: '
+                             '%(default)s)')
+    parser.add_argument('--only', action='append',
+                        choices=['scan', 'download', 'daemon'],
+                        help='run only this benchmark (repeatable)')
+    args = parser.parse_args(argv[1:])
+
+    tmpdir = tempfile.mkdtemp(prefix='vmcache_suite.')
+    try:
+        tree = os.path.join(tmpdir, 'mirror')
+        os.mkdir(tree)
+        size = int(args.size * 1024 * 1024)
+        nfiles = make_tree(tree, args.names, args.versions, size,
+                           args.depth, args.fanout)
+        server = TreeServer(tree)
+        benchmarks = [('scan', bench_scan, (server.url, args.repeat)),
+                      ('download', bench_download, (server.url, tmpdir)),
+                      ('daemon', bench_daemon, (server.url, tmpdir,
+                                                args.parallel))]
+        results = {}
+        for name, func, func_args in benchmarks:
+            if args.only and name not in args.only:
+                continue
+            results[name] = run(func, *func_args)
+            sys.stderr.write('{:8} {}\n'.format(name, ', '.join(
+                    '{}={}'.format(key, round(value, 3)
+                                   if isinstance(value, float) else value)
+                    for key, value in sorted(results[name].items()))))
+        server.stop()
+        params = dict(vars(args), files=nfiles)
+        params.pop('only')
+        json.dump({'params': params, 'results': results}, sys.stdout,
+                  indent=2, separators=(',', ': '), sort_keys=True)
+        sys.stdout.write('\n')
+    finally:
+        shutil.rmtree(tmpdir)
+    return 1 if any('error' in result for result in results.values()) else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -29,3 +29,26 @@ def to_seconds(time_dict):
             num_secs += float(value) * multiplier
     return num_secs
 
+
+def to_bytes(size):
+    '''
+    Convert a size into a number of bytes.
+    The size is either a number or a string that converts into a number
+    with an optional K, M, G, or T suffix (powers of 1024), e.g. '10M'.
+    Raises ValueError if the size cannot be converted.
+    '''
+    if isinstance(size, (int, long, float)):
+        return int(size)
+    size = str(size).strip().upper()
+    if size.endswith('B'):
+        size = size[:-1]
+    multiplier = 1
+    for suffix, value in [('K', 1024),
+                          ('M', 1024 ** 2),
+                          ('G', 1024 ** 3),
+                          ('T', 1024 ** 4)]:
+        if size.endswith(suffix):
+            size = size[:-1]
+            multiplier = value
+            break
+    return int(float(size) * multiplier)
@@ -7,7 +7,9 @@ The Daemon abstract class handles starting, stopping, and (re)configuring
 a daemon process.  The class prevents running multiple instances through
 the use of a /var/run/<daemon>.pid lock file.  The class intercepts SIGHUP
 and sets the object's reconfigure variable.  Similiarly SIGTERM and SIGINT
-set the shutdown variable.
+set the shutdown variable and SIGUSR1 sets the trigger variable, which
+daemons may use as a request to do their work now.  The sleep() method
+returns as soon as any of these signals arrives.
 
 This module will become obsolete if/when PEP 3143 (Standard daemon
 process library) is added to the standard library or python-daemon
@@ -20,10 +22,13 @@ See Linux Programming Interface, Michael Kerrisk, No Starch Press, 2010.
 '''
 
 import errno
+import fcntl
 import logging
 import os
+import select
 import signal
 import sys
+import time
 
 PID_PATHNAME = '/var/run/{name}.pid'
 
@@ -41,6 +46,8 @@ class Daemon(object):
         self.pidfile = PidFile(name)
         self.shutdown = False
         self.reconfigure = False
+        self.trigger = False
+        self.wakeup_fd = None
 
     def configure(self):
         '''
@@ -77,7 +84,7 @@ class Daemon(object):
             # do work here
 
             # wait for more work here by:
-            # 1. time.sleep() or
+            # 1. self.sleep() or
             # 2. select.select() with a timeout
 
             raise NotImplementedError()
@@ -111,9 +118,12 @@ class Daemon(object):
 
             _log.info('{} daemon started (pid={})'.format(self.name, pid))
 
-            # Register signal handlers
+            # Register signal handlers.  They also write to a pipe
+            # that wakes up sleep().
+            self.wakeup_fd = _wakeup_pipe()
             signal.signal(signal.SIGHUP, _handle_signals)
             signal.signal(signal.SIGTERM, _handle_signals)
+            signal.signal(signal.SIGUSR1, _handle_signals)
             if run_in_foreground:
                 signal.signal(signal.SIGINT, _handle_signals)
             _daemons.append(self)
@@ -148,6 +158,46 @@ class Daemon(object):
         _log.info('reconfiguring {} daemon'.format(self.name))
         self._send_signal(signal.SIGHUP)
 
+    def trigger_daemon(self):
+        '''
+        Ask the daemon to do its work now.
+        This method is not run in the daemon's process.  It sends a
+        SIGUSR1 to the daemon process which sets the trigger variable
+        and wakes the daemon up if it is sleeping.
+        '''
+        _log.info('triggering {} daemon'.format(self.name))
+        self._send_signal(signal.SIGUSR1)
+
+    def sleep(self, secs):
+        '''
+        Sleep for up to secs seconds.  Returns early if shutdown,
+        reconfigure, or trigger is set, e.g. by a signal.
+        Returns True if it slept the full time.
+        '''
+        deadline = time.time() + secs
+        while not (self.shutdown or self.reconfigure or self.trigger):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return True
+            if self.wakeup_fd is None:
+                # No signal handlers yet; poll the variables
+                time.sleep(min(remaining, 1))
+                continue
+            try:
+                readable = select.select([self.wakeup_fd], [], [],
+                                         remaining)[0]
+            except select.error, ex:
+                if ex.args[0] != errno.EINTR:
+                    raise
+                continue
+            if readable:
+                try:
+                    os.read(self.wakeup_fd, 4096)
+                except OSError, ex:
+                    if ex.errno != errno.EAGAIN:
+                        raise
+        return False
+
     def _send_signal(self, signum):
         '''
         Send a signal to the daemon process(es).
@@ -357,9 +407,23 @@ def _get_open_file_descriptors():
         fds = set(range(8192))
     return fds - logging_fds
 
+def _wakeup_pipe():
+    '''
+    Create a pipe that the signal module writes a byte to whenever a
+    signal arrives and return its non-blocking read end.
+    '''
+    rfd, wfd = os.pipe()
+    for fd in [rfd, wfd]:
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    signal.set_wakeup_fd(wfd)
+    return rfd
+
 def _handle_signals(signum, unused_frame):
     '''
-    Signal handler for SIGHUP, SIGINT, and SIGTERM.
+    Signal handler for SIGHUP, SIGINT, SIGTERM, and SIGUSR1.
     This method only sets shutdown and reconfigure variables in the
     running daemon to avoid reentrancy errors described in
     Linux Programming Interface, section 21.2.2, pp. 422-428.
@@ -370,3 +434,5 @@ def _handle_signals(signum, unused_frame):
             daemon.reconfigure = True
         elif signum == signal.SIGTERM or signum == signal.SIGINT:
             daemon.shutdown = True
+        elif signum == signal.SIGUSR1:
+            daemon.trigger = True
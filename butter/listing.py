@@ -0,0 +1,267 @@
+#!/usr/bin/python2
+'''
+Parsers of web server directory listings.
+
+parse(fp, headers) reads a listing response in chunks and returns the
+filenames it lists, directories suffixed with '/'.  The parser is
+chosen from the response headers and its first chunk by trying each
+class in PARSERS in turn:
+
+    JsonListingParser   - nginx 'autoindex_format json' listings
+    PlainListingParser  - Apache 'F=0' listings, i.e. a plain <ul> list
+    HtmlListingParser   - any other HTML page; links to files or
+                          directories directly beneath it are listed
+
+Other listing formats can be supported by inserting a class with the
+same interface into PARSERS.  Every parser removes duplicate entries
+and keeps the order of the first occurrences.
+'''
+
+from htmlentitydefs import name2codepoint
+from urllib import unquote
+from urlparse import urlsplit
+import json
+import re
+
+# Size of each read of a listing response
+BUFSIZE = 64 * 1024
+
+class ListingParser(object):
+    '''
+    Base class of the listing parsers.  Subclasses implement detect()
+    and feed(), which passes each entry to add().
+    '''
+    def __init__(self):
+        '''
+        '''
+        self.filenames = []
+        self.seen = set()
+
+    @staticmethod
+    def detect(headers, head):
+        '''
+        Can this parser handle a listing whose response has the given
+        headers (a mimetools.Message or None) and whose body starts with
+        head?
+        '''
+        raise NotImplementedError()
+
+    def feed(self, data):
+        '''
+        Parse the next chunk of the listing.
+        '''
+        raise NotImplementedError()
+
+    def close(self):
+        '''
+        Finish parsing and return the filenames.
+        '''
+        return self.filenames
+
+    def add(self, filename):
+        '''
+        Add a filename unless it is already listed.
+        '''
+        if filename not in self.seen:
+            self.seen.add(filename)
+            self.filenames.append(filename)
+
+    def add_href(self, href):
+        '''
+        Add the target of a link if it looks like a file or directory
+        directly beneath the listed directory.
+        '''
+        parts = urlsplit(href)
+        if '/' not in parts.path[:-1] and parts.path != '/' and \
+           not (parts.scheme or parts.netloc or parts.query or
+                parts.fragment):
+            self.add(unquote(href))
+
+class HtmlListingParser(ListingParser):
+    '''
+    Lists the links of an HTML page.  Only the href attributes of <a>
+    tags matter, so the page is scanned for them incrementally with a
+    regular expression rather than parsed with HTMLParser, which is
+    several times slower on large listings.
+
+    >>> parser = HtmlListingParser()
+    >>> parser.feed('<a href="a.raw">a</a> <A HREF=sub/>sub/</a> <a hr')
+    >>> parser.feed('ef="a.raw" title="t">again</a> <a href="/">/</a>')
+    >>> parser.feed("<a class='x' href='b&amp;c'>b&amp;c</a>")
+    >>> parser.close()
+    ['a.raw', 'sub/', 'b&c']
+    '''
+    _LINK = re.compile(r'''<a\s[^>]*?\bhref\s*=\s*'''
+                       r'''(?:"([^"]*)"|'([^']*)'|([^\s>]+))''',
+                       re.IGNORECASE)
+
+    def __init__(self):
+        '''
+        '''
+        ListingParser.__init__(self)
+        self.rest = ''
+
+    @staticmethod
+    def detect(unused_headers, unused_head):
+        '''
+        Any response is parsed as HTML as a last resort.
+        '''
+        return True
+
+    def feed(self, data):
+        '''
+        Scan the complete tags of data and keep the rest, which may be
+        the beginning of a tag, for the next chunk.
+        '''
+        data = self.rest + data
+        end = data.rfind('>') + 1
+        self.rest = data[end:]
+        for match in self._LINK.finditer(data, 0, end):
+            href = match.group(1) or match.group(2) or match.group(3)
+            if '&' in href:
+                href = _unescape(href)
+            self.add_href(href)
+
+class PlainListingParser(ListingParser):
+    '''
+    Lists the entries of an Apache mod_autoindex 'F=0' listing, which
+    has one '<li><a href="...">' per line, with a regular expression
+    instead of a full HTML parser.
+
+    >>> parser = PlainListingParser()
+    >>> parser.feed('<ul><li><a href="/pub/"> Parent Directory</a></li>\\n'
+    ...             '<li><a href="a%20b.raw"> a b.raw</a></li>\\n<li><a hr')
+    >>> parser.feed('ef="sub/"> sub/</a></li>\\n</ul>\\n')
+    >>> parser.close()
+    ['a b.raw', 'sub/']
+    '''
+    _HREF = re.compile(r'<li><a href="([^"]*)"', re.IGNORECASE)
+
+    def __init__(self):
+        '''
+        '''
+        ListingParser.__init__(self)
+        self.rest = ''
+
+    @staticmethod
+    def detect(unused_headers, head):
+        '''
+        '''
+        return '<ul><li><a href=' in head
+
+    def feed(self, data):
+        '''
+        Parse the complete lines of data and keep the last, partial
+        line for the next chunk.
+        '''
+        data = self.rest + data
+        end = data.rfind('\n') + 1
+        self.rest = data[end:]
+        for href in self._HREF.findall(data, 0, end):
+            if '&' in href:
+                href = _unescape(href)
+            self.add_href(href)
+
+    def close(self):
+        '''
+        '''
+        self.feed('\n')
+        return self.filenames
+
+class JsonListingParser(ListingParser):
+    '''
+    Lists the entries of an nginx 'autoindex_format json' listing.
+
+    >>> parser = JsonListingParser()
+    >>> parser.feed('[{"name":"a b.raw", "type":"file", "size":1},')
+    >>> parser.feed(' {"name":"sub", "type":"directory"}]')
+    >>> parser.close()
+    ['a b.raw', 'sub/']
+    '''
+    def __init__(self):
+        '''
+        '''
+        ListingParser.__init__(self)
+        self.chunks = []
+
+    @staticmethod
+    def detect(headers, head):
+        '''
+        '''
+        content_type = headers.getheader('Content-Type', '') \
+                            if headers else ''
+        return 'json' in content_type or head.lstrip().startswith('[')
+
+    def feed(self, data):
+        '''
+        JSON is only parsed once it is complete.
+        '''
+        self.chunks.append(data)
+
+    def close(self):
+        '''
+        Raises ValueError if the listing isn't valid.
+        '''
+        try:
+            for entry in json.loads(''.join(self.chunks)):
+                name = entry['name'].encode('utf-8')
+                if '/' in name.rstrip('/'):
+                    continue
+                if entry.get('type') == 'directory' and \
+                   not name.endswith('/'):
+                    name += '/'
+                self.add(name)
+        except (AttributeError, KeyError, TypeError), ex:
+            raise ValueError('not an nginx JSON listing: {!r}'.format(ex))
+        return self.filenames
+
+PARSERS = [JsonListingParser, PlainListingParser, HtmlListingParser]
+
+_ENTITY = re.compile(r'&(#[0-9]+|#[xX][0-9a-fA-F]+|[A-Za-z][A-Za-z0-9]*);')
+
+def parse(fp, headers=None, bufsize=BUFSIZE):
+    '''
+    Read a listing from the file-like object fp and return its
+    filenames.  headers are the response headers, if any.
+    '''
+    data = fp.read(bufsize)
+    parser = get_parser(headers, data)
+    while data:
+        parser.feed(data)
+        data = fp.read(bufsize)
+    return parser.close()
+
+def get_parser(headers, head):
+    '''
+    Return a new parser for a listing that starts with head.
+
+    >>> get_parser(None, '<html><body><pre><a href="../">../</a>')
+    ... # doctest: +ELLIPSIS
+    <butter.listing.HtmlListingParser object at ...>
+    '''
+    for cls in PARSERS:
+        if cls.detect(headers, head):
+            return cls()
+    return HtmlListingParser()
+
+def _unescape(text):
+    '''
+    Replace the character references in an attribute value with the
+    UTF-8 encoded characters.
+
+    >>> _unescape('a&amp;b&#47;&eacute;&bogus;')
+    'a&b/\\xc3\\xa9&bogus;'
+    '''
+    def replace(match):
+        name = match.group(1)
+        try:
+            if name[:2] in ['#x', '#X']:
+                codepoint = int(name[2:], 16)
+            elif name[0] == '#':
+                codepoint = int(name[1:])
+            else:
+                codepoint = name2codepoint[name]
+            return unichr(codepoint).encode('utf-8')
+        except (KeyError, ValueError):
+            return match.group(0)
+    return _ENTITY.sub(replace, text)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+'''
+Token bucket rate limiting of file I/O.
+
+A TokenBucket limits how many bytes per second pass through it.  Its
+rate can be changed at any time, e.g. after a config reload, and an
+optional time-of-day schedule selects a different rate for some hours.
+ThrottledFile wraps a file object so its reads and/or writes consume
+tokens from a bucket.
+'''
+
+from butter.convert import to_bytes
+import threading
+import time
+
+class TokenBucket(object):
+    '''
+    A thread-safe token bucket holding up to burst bytes and refilled at
+    rate bytes per second.  A rate of 0 means unlimited.
+    consume() may overdraw the bucket so reads larger than the burst
+    are allowed; the caller then sleeps until the debt is repaid.
+    '''
+    def __init__(self, rate=0, burst=None, schedule=None):
+        '''
+        Initialize the bucket.  See configure().
+        '''
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.last = time.time()
+        self.nbytes = 0
+        self.wait_secs = 0.0
+        self.configure(rate, burst, schedule)
+
+    def configure(self, rate=0, burst=None, schedule=None):
+        '''
+        Set the default rate in bytes per second and the burst size in
+        bytes (default: one second's worth).  schedule is a list of
+        (start, end, rate) tuples where start and end are seconds since
+        local midnight; the rate of the first window containing the
+        current time of day is used instead of the default rate.
+        '''
+        with self.lock:
+            self.default_rate = rate
+            self.burst = burst
+            self.schedule = schedule or []
+
+    def rate(self, now=None):
+        '''
+        Return the rate in effect at time now (default: the current
+        time).
+
+        >>> bucket = TokenBucket(100, schedule=[(22*3600, 6*3600, 0)])
+        >>> t = time.mktime((2012, 1, 1, 23, 0, 0, 0, 0, -1))
+        >>> bucket.rate(t), bucket.rate(t + 8*3600)
+        (0, 100)
+        '''
+        if not self.schedule:
+            return self.default_rate
+        tm = time.localtime(time.time() if now is None else now)
+        secs = tm.tm_hour * 3600 + tm.tm_min * 60 + tm.tm_sec
+        for start, end, rate in self.schedule:
+            if start <= end:
+                if start <= secs < end:
+                    return rate
+            elif secs >= start or secs < end:
+                # The window spans midnight
+                return rate
+        return self.default_rate
+
+    def consume(self, nbytes):
+        '''
+        Take nbytes tokens from the bucket, sleeping until the rate
+        allows them.
+        '''
+        with self.lock:
+            now = time.time()
+            rate = self.rate(now)
+            self.nbytes += nbytes
+            if not rate:
+                self.tokens = 0.0
+                self.last = now
+                return
+            burst = self.burst or rate
+            self.tokens = min(burst, self.tokens + (now - self.last) * rate)
+            self.last = now
+            self.tokens -= nbytes
+            wait = -self.tokens / rate if self.tokens < 0 else 0.0
+            self.wait_secs += wait
+        if wait:
+            time.sleep(wait)
+
+    def counters(self, reset=False):
+        '''
+        Return (bytes consumed, seconds spent waiting) since the bucket
+        was created or the counters were last reset.
+        '''
+        with self.lock:
+            result = (self.nbytes, self.wait_secs)
+            if reset:
+                self.nbytes = 0
+                self.wait_secs = 0.0
+        return result
+
+class ThrottledFile(object):
+    '''
+    A file object whose reads and writes consume tokens from buckets.
+    Other attributes are those of the wrapped file.
+    '''
+    def __init__(self, fp, read_bucket=None, write_bucket=None):
+        '''
+        Wrap fp.  Reads are limited by read_bucket and writes by
+        write_bucket if they are given.
+        '''
+        self.fp = fp
+        self.read_bucket = read_bucket
+        self.write_bucket = write_bucket
+
+    def __getattr__(self, name):
+        '''
+        Delegate everything else to the wrapped file.
+        '''
+        return getattr(self.fp, name)
+
+    def __enter__(self):
+        '''
+        '''
+        return self
+
+    def __exit__(self, *unused_exc_info):
+        '''
+        '''
+        self.fp.close()
+
+    def read(self, *args):
+        '''
+        Read from the file, then wait for tokens for what was read.
+        '''
+        buf = self.fp.read(*args)
+        if buf and self.read_bucket:
+            self.read_bucket.consume(len(buf))
+        return buf
+
+    def write(self, buf):
+        '''
+        Wait for tokens, then write to the file.
+        '''
+        if self.write_bucket:
+            self.write_bucket.consume(len(buf))
+        self.fp.write(buf)
+
+def parse_schedule(entries, key):
+    '''
+    Convert throttle_schedule config entries into the (start, end, rate)
+    tuples of TokenBucket.configure() for the rate named key.  Entries
+    without that key are skipped.  Raises ValueError for a bad entry.
+
+    >>> parse_schedule([{'from': '22:00', 'to': '6:30',
+    ...                  'download_rate': '10M'}], 'download_rate')
+    [(79200, 23400, 10485760)]
+    '''
+    schedule = []
+    for entry in entries or []:
+        if key not in entry:
+            continue
+        schedule.append((_time_of_day(entry['from']),
+                         _time_of_day(entry['to']),
+                         to_bytes(entry[key])))
+    return schedule
+
+def _time_of_day(value):
+    '''
+    Convert 'HH:MM' into seconds since midnight.  YAML reads an unquoted
+    HH:MM as a base 60 integer, i.e. minutes since midnight.
+
+    >>> _time_of_day('01:30')
+    5400
+    >>> _time_of_day(90)
+    5400
+    '''
+    if isinstance(value, (int, long)):
+        value = '{}:{}'.format(*divmod(value, 60))
+    hours, minutes = str(value).split(':')
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours <= 24 and 0 <= minutes < 60):
+        raise ValueError('bad time of day: {}'.format(value))
+    return hours * 3600 + minutes * 60
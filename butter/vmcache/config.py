@@ -5,6 +5,10 @@
 
 from butter import convert
 from butter import vfs
+from butter.throttle import TokenBucket, parse_schedule
+from butter.vmcache.digestcache import DigestCache
+from butter.vmcache.hooks import Hook
+from butter.vmcache.store import ObjectStore
 import errno
 import logging
 import re
@@ -27,9 +31,21 @@ class Config(dict):
         self.local_fs = None
         self.remote_fs = None
         self.interval_secs = None
+        self.min_interval_secs = None
+        self.max_interval_secs = None
         self.regex = None
-        self.after_download_commands = None
+        self.after_download_hooks = None
+        self.hook_timeout_secs = None
         self.keep = 1
+        self.buffer_size = None
+        self.download_segments = 1
+        self.min_segment_size = None
+        self.max_parallel_downloads = 1
+        self.digest_cache = None
+        self.object_store = None
+        # The buckets outlive reloads so running transfers see new rates
+        self.download_bucket = TokenBucket()
+        self.write_bucket = TokenBucket()
 
     def load(self):
         '''
@@ -41,25 +57,9 @@ class Config(dict):
         Returns True if the configuration was loaded, False otherwise.
         '''
         _log.debug('loading config from {}'.format(self.path))
-        newcfg = {}
-        try:
-            with open(self.path, 'r') as fp:
-                newcfg = yaml.safe_load(fp)
-                if not newcfg:
-                    _log.warn('{}: empty config file'.format(self.path))
-                    newcfg = {}
-                elif not isinstance(newcfg, dict):
-                    _log.error('{}: bad format: not a dict'
-                                .format(self.path))
-                    return False
-        except (OSError, IOError), ex:
-            if ex.errno == errno.ENOENT:
-                _log.warn('config file does not exist: {}'
-                            .format(self.path))
-            else:
-                _log.error('error reading config file {}'.format(self.path),
-                           exc_info=ex)
-                return False
+        newcfg = self._read()
+        if newcfg is None:
+            return False
 
         # Add missing values
         if 'images_url' not in newcfg:
@@ -68,6 +68,16 @@ class Config(dict):
         if 'poll_interval' not in newcfg:
             newcfg['poll_interval'] = { 'minutes' : 15 }
 
+        # The interval only adapts when these are set
+        if 'min_poll_interval' not in newcfg:
+            newcfg['min_poll_interval'] = None
+
+        if 'max_poll_interval' not in newcfg:
+            newcfg['max_poll_interval'] = None
+
+        if 'poll_jitter' not in newcfg:
+            newcfg['poll_jitter'] = 0.1
+
         if 'images_dir' not in newcfg:
             newcfg['images_dir'] = '/var/cache/vmcache'
 
@@ -81,6 +91,96 @@ class Config(dict):
         if 'keep' not in newcfg:
             newcfg['keep'] = 1
 
+        if 'buffer_size' not in newcfg:
+            newcfg['buffer_size'] = 1024 * 1024
+
+        if 'mmap_digests' not in newcfg:
+            newcfg['mmap_digests'] = False
+
+        if 'download_segments' not in newcfg:
+            newcfg['download_segments'] = 1
+
+        if 'min_segment_size' not in newcfg:
+            newcfg['min_segment_size'] = 64 * 1024 * 1024
+
+        if 'max_parallel_downloads' not in newcfg:
+            newcfg['max_parallel_downloads'] = 1
+
+        if 'decompress' not in newcfg:
+            newcfg['decompress'] = False
+
+        if 'decompress_threads' not in newcfg:
+            newcfg['decompress_threads'] = 0
+
+        if 'delta_updates' not in newcfg:
+            newcfg['delta_updates'] = True
+
+        if 'download_rate' not in newcfg:
+            newcfg['download_rate'] = 0
+
+        if 'write_rate' not in newcfg:
+            newcfg['write_rate'] = 0
+
+        if 'throttle_schedule' not in newcfg:
+            newcfg['throttle_schedule'] = []
+
+        if 'peer_port' not in newcfg:
+            newcfg['peer_port'] = 0
+
+        if 'peer_address' not in newcfg:
+            newcfg['peer_address'] = '127.0.0.1'
+
+        if 'peers' not in newcfg:
+            newcfg['peers'] = []
+
+        if 'peer_chunk_size' not in newcfg:
+            newcfg['peer_chunk_size'] = 4 * 1024 * 1024
+
+        if 'peer_workers' not in newcfg:
+            newcfg['peer_workers'] = 4
+
+        if 'metrics_port' not in newcfg:
+            newcfg['metrics_port'] = 0
+
+        if 'metrics_socket' not in newcfg:
+            newcfg['metrics_socket'] = None
+
+        if 'hook_timeout' not in newcfg:
+            newcfg['hook_timeout'] = { 'minutes' : 10 }
+
+        if 'watch_images_dir' not in newcfg:
+            newcfg['watch_images_dir'] = True
+
+        if 'digest_cache' not in newcfg:
+            newcfg['digest_cache'] = True
+
+        if 'object_store' not in newcfg:
+            newcfg['object_store'] = False
+
+        if 'walk_threads' not in newcfg:
+            newcfg['walk_threads'] = 4
+
+        if 'http_pool_size' not in newcfg:
+            newcfg['http_pool_size'] = 4
+
+        if 'http_idle_timeout' not in newcfg:
+            newcfg['http_idle_timeout'] = 30
+
+        if 's3_endpoint_url' not in newcfg:
+            newcfg['s3_endpoint_url'] = None
+
+        if 's3_region' not in newcfg:
+            newcfg['s3_region'] = None
+
+        if 's3_part_size' not in newcfg:
+            newcfg['s3_part_size'] = 16 * 1024 * 1024
+
+        if 's3_threads' not in newcfg:
+            newcfg['s3_threads'] = 4
+
+        if 's3_read_ahead' not in newcfg:
+            newcfg['s3_read_ahead'] = 32 * 1024 * 1024
+
         # Convert locations to vfs
         new_local_fs = vfs.get_filesystem(newcfg['images_dir'])
 
@@ -92,10 +192,19 @@ class Config(dict):
                         .format(self.path, url),
                         exc_info=ex)
             return False
+        _configure_http_fs(new_remote_fs, newcfg)
 
         # Parse time
         new_interval_secs = convert.to_seconds(newcfg['poll_interval'])
         _log.debug('poll_interval: {} secs'.format(new_interval_secs))
+        new_min_interval_secs = new_interval_secs
+        if newcfg['min_poll_interval']:
+            new_min_interval_secs = min(new_interval_secs,
+                    convert.to_seconds(newcfg['min_poll_interval']))
+        new_max_interval_secs = new_interval_secs
+        if newcfg['max_poll_interval']:
+            new_max_interval_secs = max(new_interval_secs,
+                    convert.to_seconds(newcfg['max_poll_interval']))
 
         # Compile regexp
         pattern = '^(?P<image>{image_regex})({digest_suffix_regex})?$' \
@@ -108,24 +217,214 @@ class Config(dict):
                         .format(self.path, ex, pattern))
             return False
 
+        # Parse rate limits
+        rates = self._parse_rates(newcfg)
+        if rates is None:
+            return False
+
+        # Parse peers
+        if isinstance(newcfg['peers'], basestring):
+            newcfg['peers'] = [newcfg['peers']]
+        try:
+            newcfg['peer_chunk_size'] = convert.to_bytes(
+                    newcfg['peer_chunk_size'])
+            for url in newcfg['peers']:
+                peer_fs = vfs.get_filesystem(url)
+                if not isinstance(peer_fs, vfs.HttpFilesystem) or \
+                   isinstance(peer_fs, vfs.S3Filesystem):
+                    raise ValueError('not an http(s) URL: {}'.format(url))
+        except (TypeError, ValueError), ex:
+            _log.error('{}: invalid peers or peer_chunk_size: {}'
+                        .format(self.path, ex))
+            return False
+
+        # Parse S3 settings
+        try:
+            newcfg['s3_part_size'] = convert.to_bytes(newcfg['s3_part_size'])
+            newcfg['s3_read_ahead'] = convert.to_bytes(
+                    newcfg['s3_read_ahead'])
+        except (TypeError, ValueError), ex:
+            _log.error('{}: invalid s3_part_size or s3_read_ahead: {}'
+                        .format(self.path, ex))
+            return False
+
         # Silently fix errors
         if newcfg['keep'] < 1:
             newcfg['keep'] = 1
+        if newcfg['buffer_size'] < 8192:
+            newcfg['buffer_size'] = 8192
+        if newcfg['download_segments'] < 1:
+            newcfg['download_segments'] = 1
+        if newcfg['min_segment_size'] < newcfg['buffer_size']:
+            newcfg['min_segment_size'] = newcfg['buffer_size']
+        if newcfg['max_parallel_downloads'] < 1:
+            newcfg['max_parallel_downloads'] = 1
+        if newcfg['peer_chunk_size'] < newcfg['buffer_size']:
+            newcfg['peer_chunk_size'] = newcfg['buffer_size']
+        if newcfg['peer_workers'] < 1:
+            newcfg['peer_workers'] = 1
+        if not newcfg['peer_address']:
+            newcfg['peer_address'] = ''
+        if newcfg['poll_jitter'] < 0:
+            newcfg['poll_jitter'] = 0
+        if newcfg['poll_jitter'] > 0.5:
+            newcfg['poll_jitter'] = 0.5
+        if newcfg['s3_part_size'] < newcfg['buffer_size']:
+            newcfg['s3_part_size'] = newcfg['buffer_size']
+        if newcfg['s3_threads'] < 1:
+            newcfg['s3_threads'] = 1
 
         after_cmds = newcfg.get('after_download')
         if after_cmds is None:
             after_cmds = []
-        elif isinstance(after_cmds, basestring):
+        elif isinstance(after_cmds, (basestring, dict)):
             after_cmds = [after_cmds]
         newcfg['after_download'] = after_cmds
+        hook_timeout = newcfg['hook_timeout']
+        if isinstance(hook_timeout, dict):
+            hook_timeout = convert.to_seconds(hook_timeout)
+        try:
+            new_hook_timeout_secs = float(hook_timeout)
+            new_hooks = [Hook.from_config(entry, new_hook_timeout_secs)
+                         for entry in after_cmds]
+        except (TypeError, ValueError), ex:
+            _log.error('{}: invalid after_download or hook_timeout: {}'
+                        .format(self.path, ex))
+            return False
 
         # Commit the changes
         self.clear()
         self.update(newcfg)
         self.local_fs = new_local_fs
+        if isinstance(self.remote_fs, vfs.S3Filesystem):
+            # Stop the transfer threads of the replaced filesystem
+            self.remote_fs.close()
         self.remote_fs = new_remote_fs
         self.interval_secs = new_interval_secs
+        self.min_interval_secs = new_min_interval_secs
+        self.max_interval_secs = new_max_interval_secs
         self.regex = new_regex
         self.keep = newcfg['keep']
-        self.after_download_commands = newcfg.get('after_download')
+        self.buffer_size = newcfg['buffer_size']
+        self.download_segments = newcfg['download_segments']
+        self.min_segment_size = newcfg['min_segment_size']
+        self.max_parallel_downloads = newcfg['max_parallel_downloads']
+        self._configure_buckets(*rates)
+        _configure_s3_fs(new_remote_fs, newcfg)
+        new_remote_fs.read_bucket = self.download_bucket
+        new_local_fs.write_bucket = self.write_bucket
+        new_local_fs.use_mmap = bool(newcfg['mmap_digests'])
+        self.digest_cache = DigestCache(new_local_fs) \
+                                if newcfg['digest_cache'] else None
+        self.object_store = ObjectStore(new_local_fs) \
+                                if newcfg['object_store'] else None
+        self.after_download_hooks = new_hooks
+        self.hook_timeout_secs = new_hook_timeout_secs
         return True
+
+    def load_rates(self):
+        '''
+        Reload only download_rate, write_rate and throttle_schedule from
+        the config file, e.g. while downloads are running.  The rest of
+        the configuration is left as it is until the next load().
+
+        Returns True if the rates were applied, False otherwise.
+        '''
+        _log.debug('loading rate limits from {}'.format(self.path))
+        newcfg = self._read()
+        if newcfg is None:
+            return False
+        for key, default in [('download_rate', 0), ('write_rate', 0),
+                             ('throttle_schedule', [])]:
+            newcfg.setdefault(key, default)
+        rates = self._parse_rates(newcfg)
+        if rates is None:
+            return False
+        self._configure_buckets(*rates)
+        return True
+
+    def _read(self):
+        '''
+        Read the config file.  A missing file is read as an empty one.
+        Returns the dictionary or None if the file cannot be read or
+        doesn't contain a dictionary.
+        '''
+        newcfg = {}
+        try:
+            with open(self.path, 'r') as fp:
+                newcfg = yaml.safe_load(fp)
+                if not newcfg:
+                    _log.warn('{}: empty config file'.format(self.path))
+                    newcfg = {}
+                elif not isinstance(newcfg, dict):
+                    _log.error('{}: bad format: not a dict'
+                                .format(self.path))
+                    return None
+        except (OSError, IOError), ex:
+            if ex.errno == errno.ENOENT:
+                _log.warn('config file does not exist: {}'
+                            .format(self.path))
+            else:
+                _log.error('error reading config file {}'.format(self.path),
+                           exc_info=ex)
+                return None
+        return newcfg
+
+    def _parse_rates(self, newcfg):
+        '''
+        Parse the rate limit values of a config dictionary.
+        Returns the (download_rate, write_rate, download_schedule,
+        write_schedule) tuple or None if a value is invalid.
+        '''
+        try:
+            return (convert.to_bytes(newcfg['download_rate']),
+                    convert.to_bytes(newcfg['write_rate']),
+                    parse_schedule(newcfg['throttle_schedule'],
+                                   'download_rate'),
+                    parse_schedule(newcfg['throttle_schedule'],
+                                   'write_rate'))
+        except (KeyError, TypeError, ValueError), ex:
+            _log.error('{}: invalid download_rate, write_rate or '
+                       'throttle_schedule: {}'.format(self.path, ex))
+            return None
+
+    def _configure_buckets(self, download_rate, write_rate,
+                           download_schedule, write_schedule):
+        '''
+        Apply parsed rate limits to the token buckets.
+        '''
+        self.download_bucket.configure(max(0, download_rate), None,
+                                       download_schedule)
+        self.write_bucket.configure(max(0, write_rate), None,
+                                    write_schedule)
+
+def _configure_http_fs(fs, cfg):
+    '''
+    Apply the HTTP tuning config values to an HttpFilesystem.
+    Other filesystems are left unchanged.
+    '''
+    if not isinstance(fs, vfs.HttpFilesystem):
+        return
+    fs.walk_threads = max(1, cfg['walk_threads'])
+    if cfg['http_pool_size'] < 1:
+        fs.pool = None
+    else:
+        fs.pool = vfs.ConnectionPool(cfg['http_pool_size'],
+                                     cfg['http_idle_timeout'])
+    if cfg.get('listing_cache_file'):
+        fs.listing_cache = vfs.ListingCache(cfg['listing_cache_file'])
+
+def _configure_s3_fs(fs, cfg):
+    '''
+    Apply the S3 config values to an S3Filesystem.
+    Other filesystems are left unchanged.
+    '''
+    if not isinstance(fs, vfs.S3Filesystem):
+        return
+    if cfg['s3_endpoint_url']:
+        fs.endpoint_url = cfg['s3_endpoint_url']
+    if cfg['s3_region']:
+        fs.region = cfg['s3_region']
+    fs.part_size = max(1, cfg['s3_part_size'])
+    fs.threads = max(1, cfg['s3_threads'])
+    fs.read_ahead = max(0, cfg['s3_read_ahead'])
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+'''
+Decompress .xz images into sparse raw images.
+
+Every consumer of a cached .raw.xz image used to decompress it itself.
+XzDecompressor lets vmcache do it once while the image is downloaded:
+compressed data is written to an xz process (which decodes multi-block
+streams on several threads) and the decompressed output is written to a
+file with runs of zero blocks left as holes, so the raw image is sparse.
+'''
+
+import errno
+import logging
+import os
+import subprocess
+import threading
+
+# Output is checked for zeros in blocks of this size; it should be
+# a multiple of the filesystem block size for holes to be created.
+SPARSE_BLOCK_SIZE = 4096
+
+_ZEROS = '\0' * SPARSE_BLOCK_SIZE
+
+_log = logging.getLogger(__name__)
+
+class DecompressError(RuntimeError):
+    '''
+    '''
+    def __init__(self, *args, **kwargs):
+        '''
+        '''
+        RuntimeError.__init__(self, *args, **kwargs)
+
+class XzDecompressor(object):
+    '''
+    Stream compressed data through xz into a sparse file.
+    Failures of the xz process are remembered instead of raised by
+    write() so they never interrupt the download feeding it; close()
+    reports them.
+    '''
+    def __init__(self, fs, path, threads=0, bufsize=1024*1024):
+        '''
+        Start an xz process that decompresses into path on fs.
+        threads is the number of xz decoder threads, 0 meaning one per
+        CPU.  Raises OSError if xz cannot be run.
+        '''
+        self.fs = fs
+        self.path = path
+        self.bufsize = bufsize
+        self.size = 0
+        self.error = None
+        self.outfp = fs.open(path, 'wb')
+        try:
+            self.proc = subprocess.Popen(['xz', '--decompress', '--stdout',
+                                          '--threads={}'.format(threads)],
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         close_fds=True)
+        except OSError:
+            self.outfp.close()
+            fs.remove(path)
+            raise
+        self.thread = threading.Thread(target=self._drain)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, buf):
+        '''
+        Feed compressed data to xz.
+        '''
+        if self.error:
+            return
+        try:
+            self.proc.stdin.write(buf)
+        except (OSError, IOError), ex:
+            self.error = 'cannot write to xz: {}'.format(ex)
+
+    def close(self):
+        '''
+        Wait for xz to decompress the rest of the data and close the
+        output file.  Raises DecompressError if decompression failed.
+        '''
+        try:
+            self.proc.stdin.close()
+        except (OSError, IOError), ex:
+            self.error = self.error or 'cannot write to xz: {}'.format(ex)
+        self.thread.join()
+        rc = self.proc.wait()
+        # Trailing holes need the file to be extended to its full size
+        self.outfp.truncate(self.size)
+        self.outfp.close()
+        if rc != 0 and not self.error:
+            self.error = 'xz exited with status {}'.format(rc)
+        if self.error:
+            raise DecompressError('{}: {}'.format(self.fs.abspath(self.path),
+                                                  self.error))
+        return self.size
+
+    def abort(self):
+        '''
+        Stop xz and delete the output file.
+        '''
+        try:
+            self.proc.kill()
+        except OSError, ex:
+            if ex.errno != errno.ESRCH:
+                raise
+        try:
+            self.proc.stdin.close()
+        except (OSError, IOError):
+            pass
+        self.thread.join()
+        self.proc.wait()
+        self.outfp.close()
+        self.fs.remove(self.path)
+
+    def _drain(self):
+        '''
+        Copy the decompressed output to the file, seeking over blocks of
+        zeros instead of writing them.  Runs in its own thread.
+        '''
+        try:
+            buf = self.proc.stdout.read(self.bufsize)
+            while buf:
+                _write_sparse(self.outfp, buf)
+                self.size += len(buf)
+                buf = self.proc.stdout.read(self.bufsize)
+        except (OSError, IOError), ex:
+            self.error = 'cannot write decompressed data: {}'.format(ex)
+            # Keep reading so xz doesn't block on a full pipe
+            while self.proc.stdout.read(self.bufsize):
+                pass
+
+def decompressed_path(path):
+    '''
+    Return the path of the decompressed image of an .xz image or None
+    if the image isn't compressed with xz.
+
+    >>> decompressed_path('/arch_20120101.raw.xz')
+    '/arch_20120101.raw'
+    >>> decompressed_path('/arch_20120101.raw') is None
+    True
+    '''
+    if path and path.endswith('.xz'):
+        return path[:-len('.xz')]
+    return None
+
+def _write_sparse(fp, buf):
+    '''
+    Write buf to fp, seeking past blocks of zeros to leave holes.
+    '''
+    start = 0
+    end = len(buf)
+    offset = 0
+    while offset < end:
+        block = buf[offset:offset + SPARSE_BLOCK_SIZE]
+        if block == _ZEROS[:len(block)]:
+            if start < offset:
+                fp.write(buf[start:offset])
+            fp.seek(len(block), os.SEEK_CUR)
+            start = offset + len(block)
+        offset += len(block)
+    if start < end:
+        fp.write(buf[start:end])
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+'''
+Block-level delta downloads between image versions.
+
+A new version of an image usually differs from the previous version in
+a few percent of its blocks.  Like zsync, the image server publishes a
+block manifest next to each image (image_path + '.blocks', see
+'butter vmcache manifest') that lists the digest of every fixed-size
+block.  A client that has an older version of the image copies the
+blocks it already has and fetches only the other byte ranges.
+
+Blocks are matched at block-aligned offsets of the old image, which is
+how filesystems inside raw disk images change.  Compressed images
+change throughout, so manifests only pay off for uncompressed images.
+'''
+
+import hashlib
+
+# Suffix of the manifest filename appended to the image filename
+MANIFEST_SUFFIX = '.blocks'
+
+# Default block size and block digest algorithm of new manifests
+BLOCK_SIZE = 64 * 1024
+BLOCK_DIGEST = 'md5'
+
+_MAGIC = 'butter-blocks 1'
+
+class ManifestError(RuntimeError):
+    '''
+    '''
+    def __init__(self, *args, **kwargs):
+        '''
+        '''
+        RuntimeError.__init__(self, *args, **kwargs)
+
+class Manifest(object):
+    '''
+    The size, digest and block digests of an image file.
+    The manifest file is a header of 'key value' lines followed by an
+    empty line and the hex digest of each block, one per line:
+
+        butter-blocks 1
+        size 1073741824
+        block-size 65536
+        block-digest md5
+        digest sha256 <hex digest of the whole image>
+
+        <hex digest of block 0>
+        ...
+    '''
+    def __init__(self, size=0, block_size=BLOCK_SIZE,
+                 block_digest=BLOCK_DIGEST, digest_type=None, digest=None,
+                 blocks=None):
+        '''
+        Initialize a manifest.
+        '''
+        self.size = size
+        self.block_size = block_size
+        self.block_digest = block_digest
+        self.digest_type = digest_type
+        self.digest = digest
+        self.blocks = blocks if blocks is not None else []
+
+    @staticmethod
+    def compute(fp, digest_type, block_size=BLOCK_SIZE,
+                block_digest=BLOCK_DIGEST):
+        '''
+        Read a file and return its manifest.
+
+        >>> from StringIO import StringIO
+        >>> m = Manifest.compute(StringIO('a' * 10), 'sha1', 4)
+        >>> m.size, len(m.blocks)
+        (10, 3)
+        >>> m.blocks[0] == m.blocks[1] != m.blocks[2]
+        True
+        '''
+        digestor = hashlib.new(digest_type)
+        manifest = Manifest(0, block_size, block_digest, digest_type)
+        block = fp.read(block_size)
+        while block:
+            digestor.update(block)
+            manifest.blocks.append(
+                    hashlib.new(block_digest, block).hexdigest())
+            manifest.size += len(block)
+            block = fp.read(block_size)
+        manifest.digest = digestor.hexdigest()
+        return manifest
+
+    @staticmethod
+    def read(fp):
+        '''
+        Parse a manifest file.  Raises ManifestError if it is malformed.
+
+        >>> from StringIO import StringIO
+        >>> m = Manifest.compute(StringIO('a' * 10), 'sha1', 4)
+        >>> out = StringIO()
+        >>> m.write(out)
+        >>> m2 = Manifest.read(StringIO(out.getvalue()))
+        >>> (m2.size, m2.block_size, m2.digest, m2.blocks) == \\
+        ...     (m.size, m.block_size, m.digest, m.blocks)
+        True
+        >>> Manifest.read(StringIO('garbage'))
+        Traceback (most recent call last):
+        ...
+        ManifestError: not a block manifest
+        '''
+        lines = iter(fp.read().splitlines())
+        if next(lines, '').strip() != _MAGIC:
+            raise ManifestError('not a block manifest')
+        header = {}
+        for line in lines:
+            line = line.strip()
+            if not line:
+                break
+            key, _, value = line.partition(' ')
+            header[key] = value
+        try:
+            digest_type, digest = header['digest'].split()
+            manifest = Manifest(int(header['size']),
+                                int(header['block-size']),
+                                header['block-digest'], digest_type, digest)
+        except (KeyError, ValueError), ex:
+            raise ManifestError('bad manifest header: {}'.format(ex))
+        if manifest.block_size < 1:
+            raise ManifestError('bad block size: {}'
+                                    .format(manifest.block_size))
+        manifest.blocks = [line.strip() for line in lines if line.strip()]
+        count = (manifest.size + manifest.block_size - 1) // \
+                manifest.block_size
+        if len(manifest.blocks) != count:
+            raise ManifestError('expected {} block digests, found {}'
+                                    .format(count, len(manifest.blocks)))
+        return manifest
+
+    def write(self, fp):
+        '''
+        Write the manifest to a file.
+        '''
+        fp.write('{}\n'.format(_MAGIC))
+        fp.write('size {}\n'.format(self.size))
+        fp.write('block-size {}\n'.format(self.block_size))
+        fp.write('block-digest {}\n'.format(self.block_digest))
+        fp.write('digest {} {}\n'.format(self.digest_type, self.digest))
+        fp.write('\n')
+        for block in self.blocks:
+            fp.write(block)
+            fp.write('\n')
+
+def manifest_path(path):
+    '''
+    Return the path of the block manifest of an image.
+
+    >>> manifest_path('/arch_20120101.raw')
+    '/arch_20120101.raw.blocks'
+    '''
+    return path + MANIFEST_SUFFIX
+
+def plan(manifest, base_fp, bufsize=1024*1024):
+    '''
+    Match the blocks of the manifest against the block-aligned blocks
+    of the base file and return a list of (offset, length, base_offset)
+    ranges that make up the new file.  base_offset is where the range
+    can be copied from in the base file, or None if it must be fetched.
+    Adjacent ranges from the same source are merged.
+
+    >>> from StringIO import StringIO
+    >>> m = Manifest.compute(StringIO('aaaabbbbccccdd'), 'sha1', 4)
+    >>> plan(m, StringIO('bbbbaaaaxxxx'))
+    [(0, 4, 4), (4, 4, 0), (8, 6, None)]
+    >>> plan(m, StringIO('aaaabbbbcccc'))
+    [(0, 12, 0), (12, 2, None)]
+    '''
+    block_size = manifest.block_size
+    chunk = max(1, bufsize // block_size) * block_size
+    have = {}
+    offset = 0
+    buf = base_fp.read(chunk)
+    while buf:
+        for i in range(0, len(buf), block_size):
+            digest = hashlib.new(manifest.block_digest,
+                                 buf[i:i + block_size]).hexdigest()
+            have.setdefault(digest, offset + i)
+        offset += len(buf)
+        buf = base_fp.read(chunk)
+
+    ranges = []
+    for i, digest in enumerate(manifest.blocks):
+        offset = i * block_size
+        length = min(block_size, manifest.size - offset)
+        source = have.get(digest)
+        if ranges:
+            last_offset, last_length, last_source = ranges[-1]
+            if (source is None and last_source is None) or \
+               (source is not None and last_source is not None and
+                source == last_source + last_length):
+                ranges[-1] = (last_offset, last_length + length, last_source)
+                continue
+        ranges.append((offset, length, source))
+    return ranges
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+'''
+A persistent cache of image digests.
+
+Computing the digest of a multi-gigabyte image takes minutes, so digests
+of local files are remembered in a JSON sidecar file.  Entries are keyed
+by the file's identity, i.e. (device, inode, size, mtime), and the digest
+algorithm, so a renamed file is still found and a modified file is
+always hashed again.
+'''
+
+import errno
+import json
+import logging
+import os
+import tempfile
+import threading
+
+_log = logging.getLogger(__name__)
+
+class DigestCache(object):
+    '''
+    A cache of the digests of files on a filesystem that supports stat().
+    '''
+    def __init__(self, fs, path='/.digests'):
+        '''
+        Load the cache from the sidecar file at path on fs.
+        '''
+        self.fs = fs
+        self.path = path
+        self.entries = {}
+        self.used = set()
+        self.dirty = False
+        self.lock = threading.Lock()
+        self._load()
+
+    def get(self, path, algorithm, st=None):
+        '''
+        Return the cached digest of the file at path or None if the
+        file has changed since its digest was cached.  st is the
+        file's os.stat() result if the caller already has it, e.g.
+        from a directory scan.
+        '''
+        key = self._key(path, algorithm, st)
+        if key is None:
+            return None
+        with self.lock:
+            digest = self.entries.get(key)
+            if digest is not None:
+                self.used.add(key)
+        return digest
+
+    def set(self, path, algorithm, digest):
+        '''
+        Remember the digest of the file at path.
+        '''
+        key = self._key(path, algorithm)
+        if key is None:
+            return
+        with self.lock:
+            if self.entries.get(key) != digest:
+                self.entries[key] = digest
+                self.dirty = True
+            self.used.add(key)
+
+    def keep(self, path, algorithm, st=None):
+        '''
+        Keep the cached digest of the file at path, if there is one,
+        when the cache is next pruned, without looking it up.
+        '''
+        key = self._key(path, algorithm, st)
+        if key is None:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.used.add(key)
+
+    def save(self, prune=False):
+        '''
+        Save the cache to its sidecar file if it has changed.
+        If prune is True, forget the digests that haven't been looked
+        up, set or kept since the cache was loaded or last pruned.
+        '''
+        with self.lock:
+            if prune:
+                for key in set(self.entries) - self.used:
+                    del self.entries[key]
+                    self.dirty = True
+                self.used = set()
+            if not self.dirty:
+                return
+            # The daemon and the command line tools may save at once,
+            # so each writes its own temporary file
+            dirname, basename = os.path.split(self.path)
+            tmp = None
+            try:
+                fd, abstmp = tempfile.mkstemp(
+                        prefix=basename + '.',
+                        dir=os.path.dirname(self.fs.abspath(self.path)))
+                tmp = os.path.join(dirname, os.path.basename(abstmp))
+                os.fchmod(fd, 0644)
+                with os.fdopen(fd, 'wb') as fp:
+                    json.dump(self.entries, fp, indent=0, sort_keys=True)
+                self.fs.rename(tmp, self.path)
+                self.dirty = False
+            except (OSError, IOError), ex:
+                _log.warning('cannot save digest cache {}: {}'
+                                .format(self.fs.abspath(self.path), ex))
+                if tmp:
+                    try:
+                        self.fs.remove(tmp)
+                    except (OSError, IOError):
+                        pass
+
+    def _key(self, path, algorithm, st=None):
+        '''
+        Return the cache key of the file at path or None if the file
+        doesn't exist.  The file is only stat()ed if st is None.
+        '''
+        if st is None:
+            try:
+                st = self.fs.stat(path)
+            except (OSError, IOError), ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+                return None
+        mtime_ns = getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9))
+        return '{}:{}:{}:{}:{}'.format(st.st_dev, st.st_ino, st.st_size,
+                                       mtime_ns, algorithm)
+
+    def _load(self):
+        '''
+        Load the cache from its sidecar file.  A missing or corrupt
+        file results in an empty cache.
+        '''
+        try:
+            with self.fs.open(self.path, 'rb') as fp:
+                entries = json.load(fp)
+            if not isinstance(entries, dict):
+                raise ValueError('not a dict')
+        except (OSError, IOError), ex:
+            if ex.errno != errno.ENOENT:
+                _log.warning('cannot read digest cache {}: {}'
+                                .format(self.fs.abspath(self.path), ex))
+            return
+        except ValueError, ex:
+            _log.warning('ignoring corrupt digest cache {}: {}'
+                            .format(self.fs.abspath(self.path), ex))
+            return
+        for key, digest in entries.iteritems():
+            self.entries[str(key)] = str(digest)
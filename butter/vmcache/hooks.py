@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+'''
+Run after_download hooks in the background.
+
+Each hook is a command that is split into arguments like a shell would
+and then run without a shell, so image paths are never interpreted by
+one.  The ordered hooks of an image run one after another and stop at
+the first failure; independent hooks run in parallel with them and
+each other.  A hook that runs longer than its timeout is killed along
+with its child processes.  None of this blocks the caller.
+
+Hooks are started from worker threads, where running Python code
+between fork and exec (Popen's preexec_fn) can deadlock.  A hook is
+therefore exec'd by a small interpreter that first puts it in a new
+session and process group of its own.
+'''
+
+from butter import convert
+from butter.vmcache import metrics
+import logging
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+# Default seconds a hook may run before it is killed
+TIMEOUT = 10 * 60
+
+# Seconds to wait for the hooks killed at shutdown to be reaped
+KILL_WAIT = 5
+
+# Execs its arguments in a new session, i.e. a new process group
+_SETSID = '''
+import os, sys
+os.setsid()
+try:
+    os.execvp(sys.argv[1], sys.argv[1:])
+except OSError as ex:
+    sys.stdout.write('cannot run {}: {}\\n'.format(sys.argv[1], ex))
+    os._exit(127)
+'''
+
+_log = logging.getLogger(__name__)
+
+class Hook(object):
+    '''
+    An after_download command.
+    '''
+    def __init__(self, command, independent=False, timeout=TIMEOUT):
+        '''
+        Initialize the hook.  Raises ValueError if the command cannot
+        be split into arguments.
+        '''
+        self.command = command
+        self.args = shlex.split(command)
+        if not self.args:
+            raise ValueError('empty command')
+        self.independent = independent
+        self.timeout = timeout
+
+    def __repr__(self):
+        '''
+        '''
+        return self.command
+
+    @staticmethod
+    def from_config(entry, timeout=TIMEOUT):
+        '''
+        Create a hook from an after_download config entry: either a
+        command string, which is an ordered hook, or a dictionary with
+        'command' and optional 'independent' and 'timeout' (seconds or
+        a poll_interval style dictionary) keys.
+        Raises ValueError if the entry is invalid.
+
+        >>> Hook.from_config('salt \\\\* cp.get_file {image_path}').args
+        ['salt', '*', 'cp.get_file', '{image_path}']
+        >>> hook = Hook.from_config({'command': 'true', 'independent': True,
+        ...                          'timeout': {'minutes': 1}})
+        >>> hook.independent, hook.timeout
+        (True, 60.0)
+        '''
+        if isinstance(entry, basestring):
+            return Hook(entry, False, timeout)
+        if not isinstance(entry, dict) or 'command' not in entry:
+            raise ValueError('not a command or a dict with a command: {!r}'
+                                .format(entry))
+        entry_timeout = entry.get('timeout', timeout)
+        if isinstance(entry_timeout, dict):
+            entry_timeout = convert.to_seconds(entry_timeout)
+        return Hook(str(entry['command']), bool(entry.get('independent')),
+                    float(entry_timeout))
+
+    def run(self, attrs, started=None):
+        '''
+        Run the hook with '{attr}' references in its arguments expanded
+        from attrs and wait for it to exit or time out.  started, if
+        given, is called with the Popen object once the hook is running.
+        Returns the exit status; negative if it was killed by a signal.
+        '''
+        label = os.path.basename(self.args[0])
+        try:
+            args = [arg.format(**attrs) for arg in self.args]
+        except (KeyError, IndexError, ValueError), ex:
+            _log.error('cannot expand {}: {!r}'.format(self.command, ex))
+            metrics.inc('vmcache_hook_failures_total', command=label)
+            return 1
+        _log.info('run: {}'.format(' '.join(args)))
+        start = time.time()
+        try:
+            with open(os.devnull) as devnull:
+                # Run the hook in its own process group so a timeout
+                # kills everything it started
+                proc = subprocess.Popen([sys.executable, '-S', '-c',
+                                         _SETSID] + args,
+                                        stdin=devnull,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        close_fds=True)
+        except OSError, ex:
+            _log.error('cannot run {}: {}'.format(args[0], ex))
+            metrics.inc('vmcache_hook_failures_total', command=label)
+            return 127
+        if started:
+            started(proc)
+        timed_out = []
+        timer = threading.Timer(self.timeout, _kill, (proc, timed_out))
+        timer.daemon = True
+        timer.start()
+        try:
+            output = proc.communicate()[0]
+        finally:
+            timer.cancel()
+        rc = proc.returncode
+        elapsed = time.time() - start
+        metrics.observe('vmcache_hook_seconds', elapsed, command=label)
+        if rc != 0:
+            metrics.inc('vmcache_hook_failures_total', command=label)
+        if output:
+            _log.debug('output of {}:\n{}'.format(args[0], output.rstrip()))
+        _log.info('exit={} after {:.1f} secs{}: {}'
+                    .format(rc, elapsed,
+                            ' (timed out)' if timed_out else '',
+                            ' '.join(args)))
+        return rc
+
+class HookRunner(object):
+    '''
+    Runs the hooks of downloaded images in background threads.
+    '''
+    def __init__(self):
+        '''
+        '''
+        self.lock = threading.Lock()
+        self.threads = []
+        self.procs = set()
+        self.stopping = False
+
+    def run(self, hooks, attrs, label):
+        '''
+        Start running hooks with the given attributes and return.
+        label names the image in log messages.
+        '''
+        ordered = [hook for hook in hooks if not hook.independent]
+        if ordered:
+            self._start(self._run_ordered, ordered, attrs, label)
+        for hook in hooks:
+            if hook.independent:
+                self._start(self._run_independent, hook, attrs, label)
+
+    def active(self):
+        '''
+        Return the number of hook threads still running.
+        '''
+        with self.lock:
+            self.threads = [thread for thread in self.threads
+                            if thread.is_alive()]
+            return len(self.threads)
+
+    def stop(self, timeout):
+        '''
+        Wait up to timeout seconds for the running hooks to exit, then
+        kill the rest along with the processes they started.  Ordered
+        hooks that have not started yet are skipped.
+        '''
+        with self.lock:
+            self.stopping = True
+            threads = list(self.threads)
+        deadline = time.time() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+        with self.lock:
+            procs = list(self.procs)
+        for proc in procs:
+            _log.warning('killing hook pid {} at shutdown'.format(proc.pid))
+            _killpg(proc)
+        deadline = time.time() + KILL_WAIT
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+        if self.active():
+            _log.warning('{} after_download hooks still running at shutdown'
+                            .format(self.active()))
+
+    def _start(self, target, *args):
+        '''
+        Run target in a new thread.
+        '''
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        with self.lock:
+            self.threads.append(thread)
+            thread.start()
+
+    def _run_ordered(self, hooks, attrs, label):
+        '''
+        Run hooks one after another until one fails.
+        '''
+        for hook in hooks:
+            if self.stopping:
+                _log.warning('skip after_download hook of {} at shutdown: {}'
+                                .format(label, hook))
+                return
+            if self._run_hook(hook, attrs) != 0:
+                _log.error('abort after_download processing of {}'
+                            .format(label))
+                return
+
+    def _run_independent(self, hook, attrs, label):
+        '''
+        Run a single hook.
+        '''
+        if self._run_hook(hook, attrs) != 0:
+            _log.error('after_download hook failed for {}: {}'
+                        .format(label, hook))
+
+    def _run_hook(self, hook, attrs):
+        '''
+        Run a hook, keeping its process where stop() can kill it.
+        '''
+        procs = []
+        def started(proc):
+            with self.lock:
+                self.procs.add(proc)
+                procs.append(proc)
+                if self.stopping:
+                    _killpg(proc)
+        try:
+            return hook.run(attrs, started)
+        finally:
+            with self.lock:
+                self.procs.difference_update(procs)
+
+def _kill(proc, timed_out):
+    '''
+    Kill a timed out hook and the processes it started.
+    '''
+    timed_out.append(True)
+    _log.warning('killing hook pid {} after timeout'.format(proc.pid))
+    _killpg(proc)
+
+def _killpg(proc):
+    '''
+    Kill a hook and the processes it started.
+    '''
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        # Its process group does not exist before the hook calls setsid
+        try:
+            proc.kill()
+        except OSError:
+            pass
@@ -2,10 +2,31 @@
 
 '''
 '''
+from butter import vfs
+from butter.vfs import NoSuchFileError
+from butter.vmcache import delta
+from butter.vmcache import metrics
+from butter.vmcache.decompress import DecompressError, XzDecompressor, \
+                                     decompressed_path
+from httplib import HTTPException
+import bisect
+import errno
 import hashlib
 import logging
 import os
-import shutil
+import re
+import sys
+import threading
+import time
+
+# Default size of the buffer used to copy and digest images.
+BUFSIZE = 1024 * 1024
+
+# Default smallest byte range fetched by a segmented download.
+MIN_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Numeric and alphabetic parts of a version string
+_VERSION_PARTS = re.compile(r'\d+|[^\W\d_]+')
 
 _log = logging.getLogger(__name__)
 
@@ -26,6 +47,8 @@ class Image(object):
         self.image_path = None
         self.digest_path = None
         self.digest_type = None
+        # os.stat() of the image file when it was scanned, if known
+        self.image_stat = None
 
     def __repr__(self):
         '''
@@ -36,9 +59,25 @@ class Image(object):
 
     def __cmp__(self, other):
         '''
-        Order images lexigraphically by name and then version.
+        Order images lexigraphically by name and then by version key.
+        '''
+        return cmp(self.name, other.name) or \
+               cmp(self.version_key, other.version_key)
+
+    @property
+    def version(self):
+        '''
+        The version string of the image.
         '''
-        return cmp(self.name, other.name) or cmp(self.version, other.version)
+        return self._version
+
+    @version.setter
+    def version(self, value):
+        '''
+        Set the version string and parse it into version_key.
+        '''
+        self._version = value
+        self.version_key = version_key(value)
 
     def is_valid(self):
         '''
@@ -47,9 +86,10 @@ class Image(object):
         '''
         return self.image_path and self.digest_path
 
-    def add_file(self, fs, path, attrs):
+    def add_file(self, fs, path, attrs, st=None):
         '''
-        Add an image or digest file to the image.
+        Add an image or digest file to the image.  st is the os.stat()
+        result of the file, if the caller has already read it.
         '''
         self.fs = fs
         self.name = attrs['name']
@@ -59,43 +99,139 @@ class Image(object):
             self.digest_type = attrs['digest']
         else:
             self.image_path = path
+            self.image_stat = st
 
     def delete(self):
         '''
-        Delete the iamge and digest files.
+        Delete the iamge and digest files and the decompressed image
+        if there is one.
         '''
         for path in [self.image_path, self.digest_path]:
             _log.debug('delete: {}'.format(self.fs.abspath(path)))
             self.fs.remove(path)
+        raw_path = decompressed_path(self.image_path)
+        if raw_path:
+            self.fs.remove(raw_path)
 
-    def download(self, dest_fs):
+    def verify(self, digest_cache=None, bufsize=BUFSIZE):
+        '''
+        Does the digest in the digest file match the image contents?
+        If a DigestCache is given, a digest it holds for the unchanged
+        image file is used instead of reading the image.
+        '''
+        expected = self.expected_digest()
+        actual = self.compute_digest(digest_cache, bufsize)
+        if actual != expected:
+            _log.error('{} digest does not match {}: {!r} != {!r}'
+                        .format(self.digest_type,
+                                self.fs.abspath(self.image_path),
+                                actual, expected))
+            return False
+        return True
+
+    def expected_digest(self):
+        '''
+        Return the digest in the digest file.
+        '''
+        return self._read_digest(self.fs, self.digest_path)
+
+    def compute_digest(self, digest_cache=None, bufsize=BUFSIZE):
+        '''
+        Return the digest of the image file, using and updating the
+        DigestCache if one is given.
+        '''
+        if digest_cache:
+            digest = digest_cache.get(self.image_path, self.digest_type,
+                                      self.image_stat)
+            if digest:
+                _log.debug('cached {} digest of {}: {}'
+                            .format(self.digest_type,
+                                    self.fs.abspath(self.image_path),
+                                    digest))
+                return digest
+        digest = self._compute_digest(self.fs, self.image_path,
+                                      self.digest_type, bufsize)
+        if digest_cache:
+            digest_cache.set(self.image_path, self.digest_type, digest)
+        return digest
+
+    def download(self, dest_fs, bufsize=BUFSIZE, segments=1,
+                 min_segment_size=MIN_SEGMENT_SIZE, digest_cache=None,
+                 decompress=False, decompress_threads=0, delta_base=None,
+                 swarm=None, store=None):
         '''
         Download the image and digest files to a temporary location,
         verify the digest matches the image, and move the files to the
         top of the dest_fs filesystem.
+        The image digest is computed while the image is copied so the
+        image is only read once.  bufsize is the size of each read.
+        A partially downloaded image is kept if the transfer fails and
+        the next download resumes where the previous one stopped.
+        If segments is greater than 1, a new download of an image at
+        least twice min_segment_size bytes is split into up to segments
+        byte ranges that are fetched concurrently.
+        The digest of the downloaded image is added to the DigestCache
+        of dest_fs if one is given.
+        If decompress is True, an .xz image is also decompressed while
+        it is downloaded into a sparse raw image next to it (see
+        butter.vmcache.decompress).  A failed decompression is logged
+        but doesn't fail the download.
+        If delta_base is a local image with the same name and the source
+        filesystem has a block manifest of the image, the image is
+        rebuilt from the blocks it shares with delta_base and only the
+        other byte ranges are fetched (see butter.vmcache.delta).
+        If a peer Swarm with peers is given, a new download is fetched
+        in chunks from peers where possible (see butter.vmcache.peer).
+        If an ObjectStore of dest_fs is given, an image whose digest is
+        already stored is linked to instead of downloaded, and a new
+        image is added to the store (see butter.vmcache.store).
         Returns an Image on the dest_fs filesystem or None if an error
                 occurred during download or if the digest doesn't match.
         '''
-        pid = os.getpid()
         dest_image  = '/{}'.format(os.path.basename(self.image_path))
         dest_digest = '/{}'.format(os.path.basename(self.digest_path))
-        parent      = os.path.basename(self.image_path)
-        tmp_image   = '/.{}.download.{}'.format(parent, pid)
-        parent      = os.path.basename(self.digest_path)
-        tmp_digest  = '/.{}.download.{}'.format(parent, pid)
+        tmp_image   = partial_path(self.image_path)
+        tmp_digest  = partial_path(self.digest_path)
+        raw_path    = decompressed_path(self.image_path)
+        if store:
+            img = self._link_stored(dest_fs, store, bufsize, digest_cache,
+                                    decompress, decompress_threads)
+            if img:
+                return img
+        decompressor = None
+        if decompress and raw_path:
+            dest_raw = '/{}'.format(os.path.basename(raw_path))
+            tmp_raw  = partial_path(raw_path)
+            try:
+                decompressor = XzDecompressor(dest_fs, tmp_raw,
+                                              decompress_threads, bufsize)
+            except OSError:
+                _log.error('cannot decompress {}'
+                            .format(self.fs.abspath(self.image_path)),
+                           exc_info=True)
 
+        keep_partial = False
         try:
-            # copy files
-            for src, tmp in [(self.image_path, tmp_image),
-                             (self.digest_path, tmp_digest)]:
-                _log.debug('download {} to {}'.format(self.fs.abspath(src),
-                                                      dest_fs.abspath(tmp)))
-                with self.fs.open(src, 'rb') as infp:
-                    with dest_fs.open(tmp, 'wb') as outfp:
-                        shutil.copyfileobj(infp, outfp)
+            try:
+                tee = decompressor.write if decompressor else None
+                actual = self._download_image(dest_fs, tmp_image, bufsize,
+                                              segments, min_segment_size,
+                                              tee, delta_base, swarm)
+                # copy digest
+                _log.debug('download {} to {}'
+                            .format(self.fs.abspath(self.digest_path),
+                                    dest_fs.abspath(tmp_digest)))
+                vfs.copy(self.fs, self.digest_path, dest_fs, tmp_digest,
+                         bufsize=bufsize)
+            except (EnvironmentError, HTTPException):
+                # Keep what we have so the next download can resume
+                _log.error('failed to download {}'
+                            .format(self.fs.abspath(self.image_path)),
+                           exc_info=True)
+                keep_partial = True
+                return None
             # verify digest
             expected = self._read_digest(dest_fs, tmp_digest)
-            actual = self._compute_digest(dest_fs, tmp_image, self.digest_type)
             if actual != expected:
                 _log.error('{} digest does not match {}: {!r} != {!r}'
                             .format(self.digest_type,
@@ -103,19 +239,21 @@ class Image(object):
                                     actual, expected))
             else:
                 try:
+                    if store:
+                        store.add(tmp_image, self.digest_type, actual)
+                    if decompressor:
+                        self._finish_decompress(dest_fs, decompressor,
+                                                dest_raw)
+                        decompressor = None
                     dest_fs.rename(tmp_image, dest_image)
                     dest_fs.rename(tmp_digest, dest_digest)
+                    if digest_cache:
+                        digest_cache.set(dest_image, self.digest_type, actual)
                     _log.info('downloaded {} and {}'
                                 .format(dest_fs.abspath(dest_image),
                                         dest_fs.abspath(dest_digest)))
-                    img = Image(self.img_id)
-                    img.fs = dest_fs
-                    img.name = self.name
-                    img.version = self.version
-                    img.image_path = dest_image
-                    img.digest_path = dest_digest
-                    img.digest_type = self.digest_type
-                    return img
+                    return self._local_image(dest_fs, dest_image,
+                                             dest_digest)
                 except:
                     _log.error('failed to rename {} and/or {}'
                                     .format(dest_fs.abspath(tmp_image),
@@ -125,10 +263,440 @@ class Image(object):
                     dest_fs.remove(dest_digest)
                     raise
         finally:
-            dest_fs.remove(tmp_image)
+            if swarm:
+                swarm.forget(os.path.basename(self.image_path))
+            if decompressor:
+                decompressor.abort()
+            if not keep_partial:
+                dest_fs.remove(tmp_image)
             dest_fs.remove(tmp_digest)
+            dest_fs.remove(segments_path(self.image_path))
         return None
 
+    def _local_image(self, dest_fs, dest_image, dest_digest):
+        '''
+        Return a copy of this image at dest_image on dest_fs.
+        '''
+        img = Image(self.img_id)
+        img.fs = dest_fs
+        img.name = self.name
+        img.version = self.version
+        img.image_path = dest_image
+        img.digest_path = dest_digest
+        img.digest_type = self.digest_type
+        return img
+
+    def _link_stored(self, dest_fs, store, bufsize=BUFSIZE,
+                     digest_cache=None, decompress=False,
+                     decompress_threads=0):
+        '''
+        If the image is in the ObjectStore and the object is intact,
+        link it into place and copy the digest file.  The raw image of
+        an .xz image is decompressed from the local object; raw images
+        are not stored since they are meant to be written to.
+        Returns an Image on dest_fs or None if the image isn't stored
+        or cannot be linked, in which case it should be downloaded.
+        '''
+        try:
+            expected = self.expected_digest()
+        except (EnvironmentError, HTTPException, NoSuchFileError):
+            # The download reports the error
+            return None
+        obj = store.lookup(self.digest_type, expected)
+        if not obj:
+            return None
+        try:
+            intact = self._stored_intact(dest_fs, obj, expected, bufsize,
+                                         digest_cache)
+        except (EnvironmentError, HTTPException, NoSuchFileError):
+            _log.error('cannot check {}'.format(dest_fs.abspath(obj)),
+                       exc_info=True)
+            return None
+        if not intact:
+            # The download stores the image again
+            _log.warning('{} was modified, removed from the store'
+                            .format(dest_fs.abspath(obj)))
+            dest_fs.remove(obj)
+            return None
+        dest_image  = '/{}'.format(os.path.basename(self.image_path))
+        dest_digest = '/{}'.format(os.path.basename(self.digest_path))
+        tmp_image   = partial_path(self.image_path)
+        tmp_digest  = partial_path(self.digest_path)
+        raw_path    = decompressed_path(self.image_path)
+        try:
+            try:
+                vfs.copy(self.fs, self.digest_path, dest_fs, tmp_digest,
+                         bufsize=bufsize)
+                store.link(obj, tmp_image)
+            except (EnvironmentError, HTTPException, NoSuchFileError):
+                _log.error('cannot link {} to {}'
+                            .format(dest_fs.abspath(obj),
+                                    dest_fs.abspath(dest_image)),
+                           exc_info=True)
+                return None
+            if decompress and raw_path:
+                dest_raw = '/{}'.format(os.path.basename(raw_path))
+                self._decompress_local(dest_fs, obj, dest_raw, bufsize,
+                                       decompress_threads)
+            dest_fs.rename(tmp_image, dest_image)
+            dest_fs.rename(tmp_digest, dest_digest)
+        finally:
+            dest_fs.remove(tmp_image)
+            dest_fs.remove(tmp_digest)
+        if digest_cache:
+            digest_cache.set(dest_image, self.digest_type, expected)
+        _log.info('linked {} to stored {} instead of downloading it'
+                    .format(dest_fs.abspath(dest_image),
+                            dest_fs.abspath(obj)))
+        return self._local_image(dest_fs, dest_image, dest_digest)
+
+    def _stored_intact(self, dest_fs, obj, expected, bufsize=BUFSIZE,
+                       digest_cache=None):
+        '''
+        Is the stored object obj still the image with the expected
+        digest?  With a DigestCache, the digest of the object is looked
+        up, or computed if the object changed since it was cached.
+        Without one, only the size of the object is compared with the
+        size of this image, if the source filesystem reports it.
+        '''
+        if digest_cache:
+            digest = digest_cache.get(obj, self.digest_type)
+            if digest is None:
+                digest = self._compute_digest(dest_fs, obj, self.digest_type,
+                                              bufsize)
+                if digest == expected:
+                    digest_cache.set(obj, self.digest_type, digest)
+            return digest == expected
+        size = self.fs.size(self.image_path)
+        return size is None or dest_fs.stat(obj).st_size == size
+
+    def _decompress_local(self, dest_fs, path, dest_raw, bufsize=BUFSIZE,
+                          decompress_threads=0):
+        '''
+        Decompress the local .xz image at path to dest_raw.
+        Errors are logged and the raw image is discarded.
+        Returns True if dest_raw was written.
+        '''
+        try:
+            decompressor = XzDecompressor(dest_fs,
+                                          partial_path(dest_raw),
+                                          decompress_threads, bufsize)
+        except OSError:
+            _log.error('cannot decompress {}'.format(dest_fs.abspath(path)),
+                       exc_info=True)
+            return False
+        try:
+            with dest_fs.open(path, 'rb') as fp:
+                while True:
+                    buf = fp.read(bufsize)
+                    if not buf:
+                        break
+                    decompressor.write(buf)
+            ok = self._finish_decompress(dest_fs, decompressor, dest_raw)
+            decompressor = None
+            return ok
+        finally:
+            if decompressor:
+                decompressor.abort()
+
+    def _finish_decompress(self, dest_fs, decompressor, dest_raw):
+        '''
+        Wait for the decompressor and move the raw image into place.
+        Errors are logged and the raw image is discarded.
+        Returns True if the raw image was moved into place.
+        '''
+        start = time.time()
+        try:
+            size = decompressor.close()
+            dest_fs.rename(decompressor.path, dest_raw)
+        except (DecompressError, OSError):
+            _log.error('failed to decompress {}'
+                        .format(self.fs.abspath(self.image_path)),
+                       exc_info=True)
+            dest_fs.remove(decompressor.path)
+            return False
+        _log.info('decompressed {} bytes to {} ({:.1f} secs after download)'
+                    .format(size, dest_fs.abspath(dest_raw),
+                            time.time() - start))
+        return True
+
+    def _download_image(self, dest_fs, tmp_image, bufsize=BUFSIZE,
+                        segments=1, min_segment_size=MIN_SEGMENT_SIZE,
+                        tee=None, delta_base=None, swarm=None):
+        '''
+        Copy the image file to tmp_image on dest_fs while computing its
+        digest.  If tmp_image already holds the beginning of the image,
+        its contents are digested and only the rest of the image is
+        requested from the source filesystem.
+        If tee is given, it is called with the image contents in order.
+        Returns the hex digest of the image.
+        '''
+        digestor = hashlib.new(self.digest_type)
+        offset = _digest_partial(dest_fs, tmp_image, digestor, bufsize, tee)
+        if not offset and delta_base:
+            actual = self._download_delta(dest_fs, tmp_image, delta_base,
+                                          bufsize, tee)
+            if actual:
+                return actual
+        if isinstance(self.fs, vfs.LocalFilesystem) and \
+           isinstance(dest_fs, vfs.LocalFilesystem):
+            return self._copy_image(dest_fs, tmp_image, offset, digestor,
+                                    bufsize, tee)
+        if not offset and swarm and swarm.peers:
+            size = self.fs.size(self.image_path)
+            if size is not None:
+                return self._download_swarm(dest_fs, tmp_image, size, swarm,
+                                            bufsize, tee)
+        if not offset and segments > 1:
+            size = self.fs.size(self.image_path)
+            if size is not None:
+                ranges = _segment_ranges(size, segments, min_segment_size)
+                if len(ranges) > 1:
+                    return self._download_segments(dest_fs, tmp_image,
+                                                   size, ranges, bufsize,
+                                                   tee)
+        if offset:
+            _log.info('resume download of {} at byte {}'
+                        .format(self.fs.abspath(self.image_path), offset))
+        _log.debug('download {} to {}'
+                    .format(self.fs.abspath(self.image_path),
+                            dest_fs.abspath(tmp_image)))
+        start = time.time()
+        with self.fs.open(self.image_path, 'rb', offset) as infp:
+            length = _remaining_length(infp, offset)
+            with dest_fs.open(tmp_image, 'ab' if offset else 'wb') as outfp:
+                nbytes, digest_secs = _copy_and_digest(infp, outfp,
+                                                       digestor, bufsize,
+                                                       tee)
+        if length is not None and nbytes < length:
+            # The connection was closed before the whole body was read
+            raise IOError('incomplete download of {}: {} of {} bytes'
+                            .format(self.fs.abspath(self.image_path),
+                                    nbytes, length))
+        elapsed = time.time() - start
+        metrics.observe('vmcache_digest_seconds', digest_secs)
+        _log.info('downloaded {} bytes in {:.1f} secs ({:.2f} MB/s), '
+                  '{:.1f} secs computing {} digest'
+                    .format(nbytes, elapsed,
+                            nbytes / elapsed / 1e6 if elapsed else 0.0,
+                            digest_secs, self.digest_type))
+        return digestor.hexdigest()
+
+    def _download_segments(self, dest_fs, tmp_image, size, ranges,
+                           bufsize=BUFSIZE, tee=None):
+        '''
+        Fetch the (offset, length) byte ranges of the image concurrently
+        into the segments_path() file, which is preallocated to size
+        bytes, and compute its digest, passing its contents to tee if it
+        is given.  The file is then renamed to tmp_image.
+        A failed segmented download cannot be resumed so the file is
+        deleted if any segment fails.
+        Returns the hex digest of the image.
+        '''
+        tmp_segments = segments_path(self.image_path)
+        _log.debug('download {} to {} in {} segments'
+                    .format(self.fs.abspath(self.image_path),
+                            dest_fs.abspath(tmp_segments), len(ranges)))
+        start = time.time()
+        with dest_fs.open(tmp_segments, 'wb') as fp:
+            fp.truncate(size)
+        errors = []
+        threads = []
+        for offset, length in ranges:
+            thread = threading.Thread(target=self._fetch_segment,
+                                      args=(dest_fs, tmp_segments, offset,
+                                            length, bufsize, errors))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            dest_fs.remove(tmp_segments)
+            raise errors[0][0], errors[0][1], errors[0][2]
+        elapsed = time.time() - start
+        digest_start = time.time()
+        actual = self._compute_digest(dest_fs, tmp_segments,
+                                      self.digest_type, bufsize, tee)
+        digest_secs = time.time() - digest_start
+        dest_fs.rename(tmp_segments, tmp_image)
+        metrics.observe('vmcache_digest_seconds', digest_secs)
+        _log.info('downloaded {} bytes in {} segments in {:.1f} secs '
+                  '({:.2f} MB/s), {:.1f} secs computing {} digest'
+                    .format(size, len(ranges), elapsed,
+                            size / elapsed / 1e6 if elapsed else 0.0,
+                            digest_secs, self.digest_type))
+        return actual
+
+    def _copy_image(self, dest_fs, tmp_image, offset, digestor,
+                    bufsize=BUFSIZE, tee=None):
+        '''
+        Copy the image from a local filesystem (e.g. an NFS mount) with
+        vfs.copy(), which lets the kernel copy or reflink the data, and
+        then digest the copied part of tmp_image.  The digestor already
+        holds the digest of the first offset bytes.
+        Returns the hex digest of the image.
+        '''
+        _log.debug('copy {} to {}'.format(self.fs.abspath(self.image_path),
+                                          dest_fs.abspath(tmp_image)))
+        start = time.time()
+        nbytes = vfs.copy(self.fs, self.image_path, dest_fs, tmp_image,
+                          offset, bufsize)
+        elapsed = time.time() - start
+        digest_start = time.time()
+        _digest_partial(dest_fs, tmp_image, digestor, bufsize, tee, offset)
+        digest_secs = time.time() - digest_start
+        metrics.observe('vmcache_digest_seconds', digest_secs)
+        _log.info('copied {} bytes in {:.1f} secs ({:.2f} MB/s), '
+                  '{:.1f} secs computing {} digest'
+                    .format(nbytes, elapsed,
+                            nbytes / elapsed / 1e6 if elapsed else 0.0,
+                            digest_secs, self.digest_type))
+        return digestor.hexdigest()
+
+    def _download_delta(self, dest_fs, tmp_image, base, bufsize=BUFSIZE,
+                        tee=None):
+        '''
+        Write the image to tmp_image in order, copying the blocks it
+        shares with the base image and fetching the other byte ranges.
+        The image is written sequentially so a failed delta download is
+        resumed like any other.
+        Returns the hex digest of the image or None if there is no
+        usable manifest or the base image has no blocks in common.
+        '''
+        manifest = self._read_manifest()
+        if manifest is None:
+            return None
+        start = time.time()
+        with base.fs.open(base.image_path, 'rb') as basefp:
+            ranges = delta.plan(manifest, basefp, bufsize)
+            fetch = [(offset, length) for offset, length, source in ranges
+                     if source is None]
+            nfetch = sum(length for unused_offset, length in fetch)
+            if manifest.size and nfetch == manifest.size:
+                _log.info('{} has no blocks in common with {}'
+                            .format(self.fs.abspath(self.image_path),
+                                    base.fs.abspath(base.image_path)))
+                return None
+            _log.debug('delta download {} to {} from {}: fetch {} of {} '
+                       'bytes in {} ranges'
+                        .format(self.fs.abspath(self.image_path),
+                                dest_fs.abspath(tmp_image),
+                                base.fs.abspath(base.image_path),
+                                nfetch, manifest.size, len(fetch)))
+            plan_secs = time.time() - start
+            digestor = hashlib.new(self.digest_type)
+            with dest_fs.open(tmp_image, 'wb') as outfp:
+                for offset, length, source in ranges:
+                    if source is None:
+                        with self.fs.open(self.image_path, 'rb', offset,
+                                          length) as infp:
+                            _copy_range(infp, outfp, length, digestor,
+                                        bufsize, tee)
+                    else:
+                        basefp.seek(source)
+                        _copy_range(basefp, outfp, length, digestor,
+                                    bufsize, tee)
+        elapsed = time.time() - start
+        _log.info('delta downloaded {} bytes in {:.1f} secs: fetched {} '
+                  'bytes in {} ranges, reused {} bytes of {} '
+                  '({:.1f} secs matching blocks)'
+                    .format(manifest.size, elapsed, nfetch, len(fetch),
+                            manifest.size - nfetch,
+                            base.fs.abspath(base.image_path), plan_secs))
+        return digestor.hexdigest()
+
+    def _read_manifest(self):
+        '''
+        Return the block manifest of the image or None if the source
+        filesystem doesn't have one that matches the digest file.
+        '''
+        path = delta.manifest_path(self.image_path)
+        try:
+            with self.fs.open(path, 'rb') as fp:
+                manifest = delta.Manifest.read(fp)
+            expected = self._read_digest(self.fs, self.digest_path)
+        except (EnvironmentError, HTTPException, NoSuchFileError), ex:
+            _log.debug('no block manifest {}: {}'
+                        .format(self.fs.abspath(path), ex))
+            return None
+        except delta.ManifestError, ex:
+            _log.warning('ignoring bad block manifest {}: {}'
+                            .format(self.fs.abspath(path), ex))
+            return None
+        if manifest.digest_type != self.digest_type or \
+           manifest.digest != expected:
+            _log.warning('ignoring stale block manifest {}: it is for '
+                         '{} digest {}'
+                            .format(self.fs.abspath(path),
+                                    manifest.digest_type, manifest.digest))
+            return None
+        return manifest
+
+    def _download_swarm(self, dest_fs, tmp_image, size, swarm,
+                        bufsize=BUFSIZE, tee=None):
+        '''
+        Fetch the image in chunks from peers and the source filesystem
+        into the segments_path() file, then compute its digest, passing
+        its contents to tee if it is given.  The file is renamed to
+        tmp_image once peers are no longer served from it.
+        A failed chunked download cannot be resumed so the file is
+        deleted if it fails.
+        Returns the hex digest of the image.
+        '''
+        tmp_segments = segments_path(self.image_path)
+        _log.debug('download {} to {} from {} peers'
+                    .format(self.fs.abspath(self.image_path),
+                            dest_fs.abspath(tmp_segments), len(swarm.peers)))
+        start = time.time()
+        try:
+            src_bytes, peer_bytes = swarm.download(self.fs, self.image_path,
+                                                   dest_fs, tmp_segments,
+                                                   size, bufsize)
+        except:
+            dest_fs.remove(tmp_segments)
+            raise
+        elapsed = time.time() - start
+        digest_start = time.time()
+        actual = self._compute_digest(dest_fs, tmp_segments,
+                                      self.digest_type, bufsize, tee)
+        digest_secs = time.time() - digest_start
+        swarm.forget(os.path.basename(self.image_path))
+        dest_fs.rename(tmp_segments, tmp_image)
+        metrics.observe('vmcache_digest_seconds', digest_secs)
+        _log.info('downloaded {} bytes in {:.1f} secs ({:.2f} MB/s): {} '
+                  'bytes from {}, {} bytes from peers, {:.1f} secs '
+                  'computing {} digest'
+                    .format(size, elapsed,
+                            size / elapsed / 1e6 if elapsed else 0.0,
+                            src_bytes, self.fs.abspath('/'), peer_bytes,
+                            digest_secs, self.digest_type))
+        return actual
+
+    def _fetch_segment(self, dest_fs, tmp_image, offset, length, bufsize,
+                       errors):
+        '''
+        Copy length bytes starting at offset from the image to the same
+        position in tmp_image.  This method runs in its own thread and
+        appends sys.exc_info() to errors if the copy fails.
+        '''
+        try:
+            with self.fs.open(self.image_path, 'rb', offset, length) as infp:
+                with dest_fs.open(tmp_image, 'r+b', offset) as outfp:
+                    remaining = length
+                    while remaining > 0:
+                        buf = infp.read(min(bufsize, remaining))
+                        if not buf:
+                            raise IOError('incomplete segment of {} at '
+                                          'byte {}: {} bytes missing'
+                                            .format(self.fs.abspath(
+                                                        self.image_path),
+                                                    offset, remaining))
+                        outfp.write(buf)
+                        remaining -= len(buf)
+        except:
+            errors.append(sys.exc_info())
+
     def _read_digest(self, fs, path):
         '''
         Read the digest from the digest file.
@@ -140,45 +708,276 @@ class Image(object):
             digest = digest.split()[0]
         return digest
 
-    def _compute_digest(self, fs, path, algorithm):
+    def _compute_digest(self, fs, path, algorithm, bufsize=BUFSIZE,
+                        tee=None):
         '''
         Compute the digest of a file.
+        If tee is given, it is also called with each buffer read.
         '''
         digestor = hashlib.new(algorithm)
+        if tee is None and _can_map(fs):
+            for view in fs.mapped_views(path):
+                digestor.update(view)
+            return digestor.hexdigest()
         with fs.open(path, 'rb') as fp:
-            buf = fp.read(8192)
+            buf = fp.read(bufsize)
             while buf:
                 digestor.update(buf)
-                buf = fp.read(8192)
+                if tee:
+                    tee(buf)
+                buf = fp.read(bufsize)
         return digestor.hexdigest()
 
+def version_key(version):
+    '''
+    Parse a version string into a key that orders versions numerically.
+    Digit runs become ints, other alphanumeric runs stay strings, and
+    separators are dropped.
+
+    >>> version_key('20120101-10')
+    (20120101, 10)
+    >>> version_key('1.10') > version_key('1.9')
+    True
+    >>> version_key('2012a')
+    (2012, 'a')
+    >>> version_key(None)
+    ()
+    '''
+    if not version:
+        return ()
+    return tuple(int(part) if part.isdigit() else part
+                 for part in _VERSION_PARTS.findall(version))
+
+def partial_path(path):
+    '''
+    Return the path of the temporary file a download of path is written
+    to.  The path is stable across processes so an interrupted download
+    can be resumed.
+
+    >>> partial_path('/dir/arch_20120101.raw.xz')
+    '/.arch_20120101.raw.xz.download'
+    '''
+    return '/.{}.download'.format(os.path.basename(path))
+
+def segments_path(path):
+    '''
+    Return the path of the temporary file a segmented or peer download
+    of path is written to.  Its byte ranges arrive out of order, so
+    unlike partial_path() it is never resumed.
+
+    >>> segments_path('/dir/arch_20120101.raw.xz')
+    '/.arch_20120101.raw.xz.segments'
+    '''
+    return '/.{}.segments'.format(os.path.basename(path))
+
+def _digest_partial(fs, path, digestor, bufsize=BUFSIZE, tee=None,
+                    offset=0):
+    '''
+    Feed the contents of a partially downloaded file from offset on to
+    the digestor and to tee if it is given.
+    Returns the number of bytes read, i.e. 0 if the file doesn't exist.
+    '''
+    nbytes = 0
+    try:
+        if tee is None and _can_map(fs):
+            for view in fs.mapped_views(path, offset):
+                digestor.update(view)
+                nbytes += len(view)
+            return nbytes
+        with fs.open(path, 'rb', offset) as fp:
+            buf = fp.read(bufsize)
+            while buf:
+                digestor.update(buf)
+                if tee:
+                    tee(buf)
+                nbytes += len(buf)
+                buf = fp.read(bufsize)
+    except (OSError, IOError), ex:
+        if ex.errno != errno.ENOENT:
+            raise
+    return nbytes
+
+def _can_map(fs):
+    '''
+    Can files of fs be hashed through mapped_views()?  Only if the
+    mmap_digests config value enabled it, since a mapped file that is
+    truncated kills the process.  Reads that are throttled go through
+    open() so the read rate is limited.
+    '''
+    return isinstance(fs, vfs.LocalFilesystem) and fs.use_mmap and \
+           fs.read_bucket is None
+
+def _stat(info):
+    '''
+    Return the stat data of a vfs.FileInfo or None if the file is gone.
+    '''
+    try:
+        return info.stat()
+    except OSError:
+        return None
+
+def _segment_ranges(size, segments, min_segment_size=MIN_SEGMENT_SIZE):
+    '''
+    Split size bytes into at most segments (offset, length) ranges of
+    at least min_segment_size bytes each.
+
+    >>> _segment_ranges(100, 4, 10)
+    [(0, 25), (25, 25), (50, 25), (75, 25)]
+    >>> _segment_ranges(100, 4, 40)
+    [(0, 50), (50, 50)]
+    >>> _segment_ranges(100, 4, 200)
+    [(0, 100)]
+    >>> _segment_ranges(10, 3, 1)
+    [(0, 4), (4, 4), (8, 2)]
+    >>> _segment_ranges(0, 4, 1)
+    [(0, 0)]
+    '''
+    count = min(segments, size // max(1, min_segment_size))
+    if count <= 1:
+        return [(0, size)]
+    length = (size + count - 1) // count
+    return [(offset, min(length, size - offset))
+            for offset in range(0, size, length)]
+
+def _remaining_length(fp, offset):
+    '''
+    Return the number of bytes an HTTP response is expected to deliver
+    after the first offset bytes, or None if the length is unknown
+    (e.g. for local files).
+    '''
+    if not hasattr(fp, 'info'):
+        return None
+    length = fp.info().getheader('Content-Length')
+    if length is None:
+        return None
+    length = int(length)
+    if offset and fp.getcode() != 206:
+        # The server ignored the Range header and the vfs skipped offset
+        length -= offset
+    return length
+
+def _copy_range(infp, outfp, length, digestor, bufsize=BUFSIZE, tee=None):
+    '''
+    Copy length bytes from infp to outfp, feeding them to the digestor
+    and to tee if it is given.  Raises IOError if infp ends early.
+    '''
+    remaining = length
+    while remaining > 0:
+        buf = infp.read(min(bufsize, remaining))
+        if not buf:
+            raise IOError('unexpected end of file: {} bytes missing'
+                            .format(remaining))
+        outfp.write(buf)
+        digestor.update(buf)
+        if tee:
+            tee(buf)
+        remaining -= len(buf)
+
+def _copy_and_digest(infp, outfp, digestor, bufsize=BUFSIZE, tee=None):
+    '''
+    Copy infp to outfp, feeding each buffer to the digestor (and to
+    tee if it is given) as it is written.
+    Returns a (number of bytes copied, seconds spent digesting) tuple.
+    '''
+    nbytes = 0
+    digest_secs = 0.0
+    buf = infp.read(bufsize)
+    while buf:
+        outfp.write(buf)
+        start = time.time()
+        digestor.update(buf)
+        digest_secs += time.time() - start
+        if tee:
+            tee(buf)
+        nbytes += len(buf)
+        buf = infp.read(bufsize)
+    return nbytes, digest_secs
+
 class Images(dict):
     '''
     A dictionary of all valid images found on a filesystem.
+    The images are also indexed by name in version order so names(),
+    latest() and images() don't scan the whole dictionary.  The index
+    is built on first use and kept up-to-date by item assignment and
+    deletion; other changes to the images rebuild it.
     '''
-    def __init__(self, fs, regex):
+    def __init__(self, fs=None, regex=None):
         '''
         Initialize the dictionary with the contents of a filesystem.
         This method walks the filesystem and remembers images that
-        match the given regex pattern.
+        match the given regex pattern.  If fs is None, the dictionary
+        starts empty.
         '''
         dict.__init__(self)
+        self._by_name = None
+        if fs is None:
+            return
         _log.debug('scanning {}'.format(fs.abspath('/')))
-        for root, unused_dirs, files in fs.walk('/'):
-            for filename in files:
-                if root == '/':
-                    path = '/' + filename
-                else:
-                    path = root + '/' + filename
-                match = regex.match(filename)
-                if match:
-                    attrs = match.groupdict()
-                    img_id = attrs['image']
-                    _log.debug('add {}'.format(fs.abspath(path)))
-                    self[img_id].add_file(fs, path, attrs)
-                else:
-                    _log.debug('ignore {}: does not match regex'
-                                .format(fs.abspath(path)))
+        if isinstance(fs, vfs.LocalFilesystem):
+            # Keep the stat data of the images for the digest cache
+            for unused_root, unused_dirs, files in fs.walk_stat('/'):
+                for info in files:
+                    st = _stat(info) if regex.match(info.name) else None
+                    self.add_path(fs, info.path, regex, st)
+        else:
+            for root, unused_dirs, files in fs.walk('/'):
+                for filename in files:
+                    if root == '/':
+                        path = '/' + filename
+                    else:
+                        path = root + '/' + filename
+                    self.add_path(fs, path, regex)
+        self.discard_invalid()
+
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug('found {} valid images'.format(len(self)))
+            for img in self.values():
+                _log.debug('valid image: {}'.format(img))
+
+    def add_path(self, fs, path, regex, st=None):
+        '''
+        Add the image or digest file at path if its filename matches
+        the regex.  st is its os.stat() result, if known.  The image
+        may not be valid until both of its files have been added.
+        Returns True if the file was added.
+        '''
+        match = regex.match(os.path.basename(path))
+        if not match:
+            _log.debug('ignore {}: does not match regex'
+                        .format(fs.abspath(path)))
+            return False
+        attrs = match.groupdict()
+        img_id = attrs['image']
+        _log.debug('add {}'.format(fs.abspath(path)))
+        self[img_id].add_file(fs, path, attrs, st)
+        self._by_name = None
+        return True
+
+    def remove_path(self, path, regex):
+        '''
+        Forget the image or digest file at path.  The image is removed
+        from the dictionary once neither of its files remains.
+        Returns True if the file was known.
+        '''
+        match = regex.match(os.path.basename(path))
+        img = self.get(match.group('image')) if match else None
+        if img is None:
+            return False
+        if img.image_path == path:
+            img.image_path = None
+        elif img.digest_path == path:
+            img.digest_path = None
+        else:
+            return False
+        _log.debug('remove {}'.format(img.fs.abspath(path)))
+        if img.image_path is None and img.digest_path is None:
+            del self[img.img_id]
+        return True
+
+    def discard_invalid(self):
+        '''
+        Remove images that lack an image or digest file.
+        '''
         rmlist = []
         for name, img in sorted(self.iteritems()):
             if not img.is_valid():
@@ -189,11 +988,6 @@ class Images(dict):
             for name in rmlist:
                 del self[name]
 
-        if _log.isEnabledFor(logging.DEBUG):
-            _log.debug('found {} valid images'.format(len(self)))
-            for img in self.values():
-                _log.debug('valid image: {}'.format(img))
-
     def __missing__(self, img_id):
         '''
         Create a missing image given the image name.
@@ -202,44 +996,86 @@ class Images(dict):
         self[img_id] = value
         return value
 
+    def __setitem__(self, img_id, img):
+        '''
+        Add or replace an image and update the name index.
+        '''
+        if img_id in self:
+            self._unindex(img_id)
+        dict.__setitem__(self, img_id, img)
+        if self._by_name is not None:
+            if img.name is None:
+                # An empty image from __missing__; index it once named
+                self._by_name = None
+            else:
+                bisect.insort(self._by_name.setdefault(img.name, []),
+                              (img.version_key, img_id))
+
+    def __delitem__(self, img_id):
+        '''
+        Remove an image and update the name index.
+        '''
+        self._unindex(img_id)
+        dict.__delitem__(self, img_id)
+
     def names(self):
         '''
         Return the set of image names inside the dictionary.
         This is not the same as img_id (the dictionary's key) which is
         the basename of the image file.
         '''
-        names = set()
-        for img in self.values():
-            names.add(img.name)
-        return names
+        return set(self._index())
 
     def latest(self, name):
         '''
         Find the latest named image.
         '''
-        latest = None
-        for img in self.values():
-            if img.name != name:
-                continue
-            if latest is not None and img < latest:
-                continue
-            if latest is None:
-                latest = img
-            elif latest < img:
-                latest = img
-        return latest
+        keys = self._index().get(name)
+        if not keys:
+            return None
+        return self[keys[-1][1]]
 
     def images(self, name):
         '''
         Return a list of named images ordered by version where oldest
         version is at the beginning of the list.
         '''
-        images = []
-        for img in self.values():
-            if img.name == name:
-                images.append(img)
-        images.sort()
-        return images
+        return [self[img_id] for unused_key, img_id
+                in self._index().get(name, [])]
+
+    def _index(self):
+        '''
+        Return the index that maps each name to a list of
+        (version_key, img_id) sorted by version, building it if needed.
+        '''
+        by_name = self._by_name
+        if by_name is None:
+            by_name = {}
+            for img_id, img in self.iteritems():
+                by_name.setdefault(img.name, []).append((img.version_key,
+                                                         img_id))
+            for keys in by_name.values():
+                keys.sort()
+            self._by_name = by_name
+        return by_name
+
+    def _unindex(self, img_id):
+        '''
+        Remove an image from the name index.
+        '''
+        if self._by_name is None:
+            return
+        img = self[img_id]
+        keys = self._by_name.get(img.name)
+        entry = (img.version_key, img_id)
+        i = bisect.bisect_left(keys, entry) if keys else 0
+        if not keys or i == len(keys) or keys[i] != entry:
+            # The image changed since it was indexed
+            self._by_name = None
+            return
+        keys.pop(i)
+        if not keys:
+            del self._by_name[img.name]
 
     def delete(self, img_id):
         '''
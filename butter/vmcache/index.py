@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+'''
+An incrementally maintained index of the images on a local filesystem.
+
+Walking images_dir every poll costs more as the directory fills up with
+unrelated files.  LocalIndex scans the directory once and then follows
+changes with Linux inotify (through ctypes, no extra dependencies).
+It falls back to a full scan when inotify is unavailable, when the
+kernel's event queue overflows, or when the watched tree is moved.
+'''
+
+from butter.vmcache.image import Images
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+
+_log = logging.getLogger(__name__)
+
+# inotify constants from <sys/inotify.h>
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_MOVE_SELF    = 0x00000800
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_ISDIR        = 0x40000000
+IN_NONBLOCK     = 0x00000800
+IN_CLOEXEC      = 0x00080000
+
+_WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | \
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+_EVENT = struct.Struct('iIII')
+
+class LocalIndex(object):
+    '''
+    The images on a local filesystem, kept up-to-date by inotify.
+    '''
+    def __init__(self, fs, regex):
+        '''
+        Initialize the index.  The filesystem is scanned on the first
+        call to images().
+        '''
+        self.fs = fs
+        self.regex = regex
+        self.all = None
+        self.watches = {}
+        self.inotify = None
+        try:
+            self.inotify = _Inotify()
+        except (OSError, AttributeError), ex:
+            _log.warning('inotify unavailable, scanning {} every poll: {}'
+                            .format(fs.abspath('/'), ex))
+
+    def close(self):
+        '''
+        Stop watching the filesystem.
+        '''
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+
+    def images(self):
+        '''
+        Return an Images dictionary of the valid local images.
+        '''
+        if self.inotify is None:
+            return Images(self.fs, self.regex)
+        if self.all is None or not self._update():
+            if not self._rescan():
+                return Images(self.fs, self.regex)
+        images = Images()
+        for img_id, img in self.all.iteritems():
+            if img.is_valid():
+                images[img_id] = img
+        return images
+
+    def _rescan(self):
+        '''
+        Rebuild the index from scratch and (re)watch every directory.
+        If the filesystem's root doesn't exist (yet), the index is
+        rebuilt on the next call; if a directory cannot be watched for
+        any other reason, inotify is given up.
+        Returns True if the index is valid.
+        '''
+        _log.debug('rescan {}'.format(self.fs.abspath('/')))
+        for wd in self.watches.keys():
+            self.inotify.rm_watch(wd)
+        self.watches.clear()
+        self.inotify.drain()
+        self.all = Images()
+        if not self._scan('/'):
+            self.all = None
+            if os.path.isdir(self.fs.abspath('/')):
+                self.close()
+            else:
+                _log.debug('{} does not exist, scanning until it does'
+                            .format(self.fs.abspath('/')))
+            return False
+        return True
+
+    def _scan(self, root):
+        '''
+        Watch every directory at or below root and add their files.
+        Directories are watched before they are listed so files created
+        while scanning aren't missed.
+        Returns False if a directory cannot be watched, including the
+        root of the filesystem if it doesn't exist.
+        '''
+        watched_root = False
+        for dirpath, unused_dirs, files in self.fs.walk(root):
+            try:
+                wd = self.inotify.add_watch(self.fs.abspath(dirpath),
+                                            _WATCH_MASK)
+            except OSError, ex:
+                if ex.errno == errno.ENOENT:
+                    if dirpath == '/':
+                        return False
+                    continue
+                _log.warning('cannot watch {}, scanning every poll: {}'
+                                .format(self.fs.abspath(dirpath), ex))
+                return False
+            self.watches[wd] = dirpath
+            watched_root = watched_root or dirpath == '/'
+            for filename in files:
+                self.all.add_path(self.fs, _join(dirpath, filename),
+                                  self.regex)
+        return watched_root or root != '/'
+
+    def _update(self):
+        '''
+        Apply the pending inotify events to the index.
+        Returns False if the index must be rebuilt.
+        '''
+        for wd, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                _log.info('inotify queue overflow')
+                return False
+            dirpath = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if dirpath is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # Subdirectories are handled by their parent's events
+                if dirpath == '/':
+                    _log.debug('{} moved or deleted'
+                                .format(self.fs.abspath(dirpath)))
+                    return False
+                continue
+            path = _join(dirpath, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    if not self._scan(path):
+                        return False
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._forget_dir(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self.all.add_path(self.fs, path, self.regex)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.all.remove_path(path, self.regex)
+        return True
+
+    def _forget_dir(self, dirpath):
+        '''
+        Forget every file at or below dirpath.
+        '''
+        prefix = dirpath + '/'
+        for img in self.all.values():
+            for path in [img.image_path, img.digest_path]:
+                if path and path.startswith(prefix):
+                    self.all.remove_path(path, self.regex)
+        for wd, watched in self.watches.items():
+            if watched == dirpath or watched.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+class _Inotify(object):
+    '''
+    A minimal ctypes wrapper around the Linux inotify API.
+    '''
+    def __init__(self):
+        '''
+        Create a non-blocking inotify instance.
+        Raises OSError or AttributeError if inotify isn't available.
+        '''
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def close(self):
+        '''
+        Close the inotify instance which removes all watches.
+        '''
+        os.close(self.fd)
+
+    def add_watch(self, path, mask):
+        '''
+        Watch path and return the watch descriptor.
+        '''
+        wd = self._add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        '''
+        Stop watching a watch descriptor.  Errors are ignored because
+        the kernel removes watches of deleted directories by itself.
+        '''
+        self._rm_watch(self.fd, wd)
+
+    def drain(self):
+        '''
+        Discard all pending events.
+        '''
+        for unused_event in self.read_events():
+            pass
+
+    def read_events(self):
+        '''
+        Generate (wd, mask, name) for each pending event.
+        '''
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except OSError, ex:
+                if ex.errno == errno.EAGAIN:
+                    return
+                raise
+            offset = 0
+            while offset < len(buf):
+                wd, mask, unused_cookie, length = \
+                        _EVENT.unpack_from(buf, offset)
+                offset += _EVENT.size
+                name = buf[offset:offset + length].rstrip('\0')
+                offset += length
+                yield wd, mask, name
+
+def _join(dirpath, filename):
+    '''
+    Join a directory path and a filename the way Images does.
+
+    >>> _join('/', 'a')
+    '/a'
+    >>> _join('/x', 'a')
+    '/x/a'
+    '''
+    if dirpath == '/':
+        return '/' + filename
+    return dirpath + '/' + filename
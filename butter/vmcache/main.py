@@ -4,6 +4,8 @@
 The command line interface to vmcache.
 '''
 
+from butter.vmcache import delta
+from butter.vmcache import image
 from butter.vmcache.config import Config
 from butter.vmcache.server import VmCacheDaemon
 import argparse
@@ -31,7 +33,7 @@ def main(argv):
         config = Config(args.configfile)
         config.load()
         _start_log(config, args)
-        args.func(config, args)
+        return args.func(config, args)
     except KeyboardInterrupt:
         sys.stderr.write('interrupted\n')
         return 1
@@ -71,6 +73,75 @@ def _parse(args):
                          help='debug output' )
     stop_parser.set_defaults(func=_stop)
 
+    # sync subcommand
+    sync_parser = subparsers.add_parser('sync',
+                            help='make the cache server check for new images')
+    sync_parser.add_argument('-c',
+                        dest='configfile',
+                        default=CONFIG_FILE,
+                        help='vmcache config file')
+    sync_parser.add_argument( '-d',
+                         dest='debug',
+                         action='store_true',
+                         help='debug output' )
+    sync_parser.set_defaults(func=_sync)
+
+    # verify subcommand
+    verify_parser = subparsers.add_parser('verify',
+                                          help='verify cached image digests')
+    verify_parser.add_argument('-c',
+                        dest='configfile',
+                        default=CONFIG_FILE,
+                        help='vmcache config file')
+    verify_parser.add_argument( '-d',
+                         dest='debug',
+                         action='store_true',
+                         help='debug output' )
+    verify_parser.add_argument('--no-cache',
+                               dest='use_cache',
+                               action='store_false',
+                               help='recompute every digest')
+    verify_parser.set_defaults(func=_verify)
+
+    # manifest subcommand
+    manifest_parser = subparsers.add_parser('manifest',
+                                help='write block manifests for delta updates')
+    manifest_parser.add_argument('-c',
+                        dest='configfile',
+                        default=CONFIG_FILE,
+                        help='vmcache config file')
+    manifest_parser.add_argument( '-d',
+                         dest='debug',
+                         action='store_true',
+                         help='debug output' )
+    manifest_parser.add_argument('-a',
+                                 dest='algorithm',
+                                 help='image digest algorithm (default: '
+                                      'from the image digest file or sha256)')
+    manifest_parser.add_argument('-b',
+                                 dest='block_size',
+                                 type=int,
+                                 default=delta.BLOCK_SIZE,
+                                 help='block size in bytes')
+    manifest_parser.add_argument('images',
+                                 nargs='+',
+                                 metavar='IMAGE',
+                                 help='image file')
+    manifest_parser.set_defaults(func=_manifest)
+
+    # dedup subcommand
+    dedup_parser = subparsers.add_parser('dedup',
+                                help='link identical images to one copy')
+    dedup_parser.add_argument('-c',
+                        dest='configfile',
+                        default=CONFIG_FILE,
+                        help='vmcache config file')
+    dedup_parser.add_argument( '-d',
+                         dest='debug',
+                         action='store_true',
+                         help='debug output' )
+    dedup_parser.set_defaults(func=_dedup)
+
     return parser.parse_args(args)
 
 def _start_log(config, args):
@@ -159,5 +230,94 @@ def _stop(config, args):
     daemon = VmCacheDaemon(config, args)
     daemon.stop()
 
+def _sync(config, args):
+    '''
+    Make the cache server check for new images now.
+    '''
+    daemon = VmCacheDaemon(config, args)
+    daemon.trigger_daemon()
+
+def _verify(config, args):
+    '''
+    Verify the digests of the local images.
+    Only images that changed since their digest was cached are read.
+    Returns 0 if every image matches its digest file, 1 otherwise.
+    '''
+    cache = config.digest_cache if args.use_cache else None
+    local = image.Images(config.local_fs, config.regex)
+    rc = 0
+    for img_id, img in sorted(local.iteritems()):
+        ok = img.verify(cache, config.buffer_size)
+        print '{}: {}'.format(img_id, 'OK' if ok else 'FAILED')
+        if not ok:
+            rc = 1
+    if cache:
+        cache.save(prune=True)
+    return rc
+
+def _dedup(config, args):
+    '''
+    Add the local images to the object store, e.g. the images that were
+    downloaded before it was enabled.  Images are verified first so
+    only intact images are stored, and identical images are replaced
+    by links to one stored copy.
+    Returns 0 if every image was stored, 1 otherwise.
+    '''
+    store = config.object_store
+    if not store:
+        print 'object_store is disabled in {}'.format(config.path)
+        return 1
+    local = image.Images(config.local_fs, config.regex)
+    rc = 0
+    saved = 0
+    for img_id, img in sorted(local.iteritems()):
+        digest = img.compute_digest(config.digest_cache, config.buffer_size)
+        if digest != img.expected_digest():
+            print '{}: FAILED, not stored'.format(img_id)
+            rc = 1
+            continue
+        # Count allocated space
+        size = img.fs.stat(img.image_path).st_blocks * 512
+        linked = store.add(img.image_path, img.digest_type, digest)
+        if linked:
+            saved += size
+        print '{}: {}'.format(img_id, 'linked' if linked else 'stored')
+    if config.digest_cache:
+        config.digest_cache.save(prune=True)
+    print '{} bytes freed'.format(saved)
+    return rc
+
+def _manifest(config, args):
+    '''
+    Write the block manifest of each image file next to it.  The image
+    digest algorithm is taken from the image's digest file (found with
+    the configured regex) unless it is given on the command line.
+    '''
+    for path in args.images:
+        algorithm = args.algorithm or _digest_type(config, path) or 'sha256'
+        dest = delta.manifest_path(path)
+        tmp = os.path.join(os.path.dirname(dest),
+                           '.{}.tmp'.format(os.path.basename(dest)))
+        with open(path, 'rb') as fp:
+            manifest = delta.Manifest.compute(fp, algorithm, args.block_size)
+        with open(tmp, 'wb') as fp:
+            manifest.write(fp)
+        os.rename(tmp, dest)
+        print '{}: {} blocks'.format(dest, len(manifest.blocks))
+    return 0
+
+def _digest_type(config, path):
+    '''
+    Return the digest algorithm of the digest file next to an image
+    or None if there isn't one.
+    '''
+    dirname, filename = os.path.split(os.path.abspath(path))
+    for name in sorted(os.listdir(dirname)):
+        match = config.regex.match(name)
+        if match and match.group('image') == filename and \
+           match.group('digest'):
+            return match.group('digest')
+    return None
+
 if __name__ == '__main__':
     main(sys.argv)
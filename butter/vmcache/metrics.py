@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+'''
+vmcache metrics in the Prometheus text format.
+
+The modules of vmcache record metrics in the module-level REGISTRY with
+inc(), gauge(), and observe(), much like they log with a module logger.
+MetricsServer serves the registry at /metrics over HTTP, either on a
+TCP port or on a Unix socket, so the sync lag and the time spent in
+each part of a poll can be graphed and alerted on.
+
+Summaries only have _sum and _count series; quantiles are left to
+Prometheus.
+'''
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import TCPServer, ThreadingMixIn
+import errno
+import logging
+import os
+import socket
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+_log = logging.getLogger(__name__)
+
+class Registry(object):
+    '''
+    Counters, gauges, and summaries with optional labels.
+
+    >>> reg = Registry()
+    >>> reg.define('downloads_total', 'counter', 'Finished downloads.')
+    >>> reg.define('scan_seconds', 'summary', 'Time spent scanning.')
+    >>> reg.inc('downloads_total', result='ok')
+    >>> reg.inc('downloads_total', result='ok')
+    >>> reg.observe('scan_seconds', 0.5)
+    >>> reg.observe('scan_seconds', 1.5)
+    >>> print reg.render(),
+    # HELP downloads_total Finished downloads.
+    # TYPE downloads_total counter
+    downloads_total{result="ok"} 2
+    # HELP scan_seconds Time spent scanning.
+    # TYPE scan_seconds summary
+    scan_seconds_sum 2.0
+    scan_seconds_count 2
+    '''
+    def __init__(self):
+        '''
+        '''
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.values = {}
+
+    def define(self, name, kind, text):
+        '''
+        Add a metric.  kind is 'counter', 'gauge', or 'summary' and text
+        is its help text.
+        '''
+        with self.lock:
+            self.metrics[name] = (kind, text)
+            self.values.setdefault(name, {})
+
+    def inc(self, metric, value=1, **labels):
+        '''
+        Add value to a counter.
+        '''
+        key = _label_key(labels)
+        with self.lock:
+            values = self.values[metric]
+            values[key] = values.get(key, 0) + value
+
+    def gauge(self, metric, value, **labels):
+        '''
+        Set a gauge.
+        '''
+        with self.lock:
+            self.values[metric][_label_key(labels)] = value
+
+    def observe(self, metric, value, **labels):
+        '''
+        Add an observation, e.g. a duration in seconds, to a summary.
+        '''
+        key = _label_key(labels)
+        with self.lock:
+            values = self.values[metric]
+            total, count = values.get(key, (0.0, 0))
+            values[key] = (total + value, count + 1)
+
+    def render(self):
+        '''
+        Return the metrics in the Prometheus text format.  Metrics
+        without values are left out.
+        '''
+        lines = []
+        with self.lock:
+            for name in sorted(self.metrics):
+                values = self.values[name]
+                if not values:
+                    continue
+                kind, text = self.metrics[name]
+                lines.append('# HELP {} {}'.format(name, _escape(text)))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for key in sorted(values):
+                    labels = _format_labels(key)
+                    if kind == 'summary':
+                        total, count = values[key]
+                        lines.append('{}_sum{} {!r}'.format(name, labels,
+                                                            float(total)))
+                        lines.append('{}_count{} {}'.format(name, labels,
+                                                            count))
+                    else:
+                        lines.append('{}{} {!r}'.format(name, labels,
+                                                        values[key]))
+        return ''.join(line + '\n' for line in lines)
+
+REGISTRY = Registry()
+
+inc = REGISTRY.inc
+gauge = REGISTRY.gauge
+observe = REGISTRY.observe
+
+for _name, _kind, _text in [
+        ('vmcache_download_bytes_total', 'counter',
+         'Bytes read from images_url and peers.'),
+        ('vmcache_write_bytes_total', 'counter',
+         'Bytes written to images_dir by downloads.'),
+        ('vmcache_downloads_total', 'counter',
+         'Image downloads by image name and result.'),
+        ('vmcache_download_seconds', 'summary',
+         'Time spent downloading images, by image name.'),
+        ('vmcache_download_bytes_per_second', 'gauge',
+         'Throughput of the last download of each image name.'),
+        ('vmcache_digest_seconds', 'summary',
+         'Time spent computing the digests of downloaded images.'),
+        ('vmcache_remote_scan_seconds', 'summary',
+         'Time spent listing the images at images_url.'),
+        ('vmcache_local_scan_seconds', 'summary',
+         'Time spent listing the images in images_dir.'),
+        ('vmcache_images_behind', 'gauge',
+         'Remote versions newer than the latest local version, by image '
+         'name.'),
+        ('vmcache_hook_seconds', 'summary',
+         'Run time of after_download hooks, by command.'),
+        ('vmcache_hook_failures_total', 'counter',
+         'after_download hooks that failed or timed out, by command.'),
+        ('vmcache_last_poll_timestamp_seconds', 'gauge',
+         'Unix time of the end of the last poll.'),
+        ('vmcache_last_sync_timestamp_seconds', 'gauge',
+         'Unix time of the end of the last poll in which every image '
+         'name was synced without errors.')]:
+    REGISTRY.define(_name, _kind, _text)
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    '''
+    Serves a Registry at /metrics on a TCP port or, if path is given,
+    on a Unix socket.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, address='', path=None, registry=REGISTRY):
+        '''
+        Bind the server.  A stale Unix socket at path is replaced.
+        Raises socket.error if binding fails.
+        '''
+        self.path = path
+        self.registry = registry
+        self.thread = None
+        if path:
+            self.address_family = socket.AF_UNIX
+            try:
+                os.remove(path)
+            except OSError, ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+            HTTPServer.__init__(self, path, _MetricsHandler)
+            self.port = None
+        else:
+            HTTPServer.__init__(self, (address, port), _MetricsHandler)
+            self.port = self.server_address[1]
+
+    def __str__(self):
+        '''
+        '''
+        return self.path or 'port {}'.format(self.port)
+
+    def server_bind(self):
+        '''
+        Bind the socket.  HTTPServer.server_bind only handles TCP.
+        '''
+        if not self.path:
+            HTTPServer.server_bind(self)
+            return
+        TCPServer.server_bind(self)
+        self.server_name = socket.gethostname()
+        self.server_port = 0
+
+    def start(self):
+        '''
+        Serve requests in a background thread.
+        '''
+        _log.info('serving metrics on {}'.format(self))
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Stop serving and close (and remove) the server socket.
+        '''
+        if self.thread:
+            self.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server_close()
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    '''
+    Handle a metrics request.
+    '''
+    def address_string(self):
+        '''
+        Unix socket clients have no address.
+        '''
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, fmt, *args):
+        '''
+        Log requests with the logging module instead of to stderr.
+        '''
+        _log.debug('metrics {}: {}'.format(self.address_string(),
+                                           fmt % args))
+
+    def do_GET(self):
+        '''
+        '''
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def _label_key(labels):
+    '''
+    Return a hashable, sorted form of a labels dictionary.
+    '''
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _format_labels(key):
+    '''
+    Format the labels of a series.
+
+    >>> print _format_labels((('command', 'say "hi"'), ('name', 'arch')))
+    {command="say \\"hi\\"",name="arch"}
+    '''
+    if not key:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(label, _escape(value, True))
+                          for label, value in key) + '}'
+
+def _escape(text, quote=False):
+    '''
+    Escape help text or, if quote is True, a label value.
+    '''
+    text = text.replace('\\', '\\\\').replace('\n', '\\n')
+    if quote:
+        text = text.replace('"', '\\"')
+    return text
@@ -0,0 +1,636 @@
+#!/usr/bin/env python
+
+'''
+Peer-to-peer distribution of images between vmcache daemons.
+
+Without peers every hypervisor downloads each new image from the one
+images_url server at the same time.  With peers, each vmcache daemon
+serves the images in its images_dir over HTTP (PeerServer), including
+the chunks of images it is still downloading, and downloads new images
+in chunks (Swarm): a chunk is fetched from a peer that has it, and only
+chunks that no peer has or is fetching come from images_url.  The
+images_url server thus uploads each chunk about once however many
+daemons there are.  Chunks from peers aren't trusted; the digest of the
+whole image is still checked.
+
+A PeerServer can also be another daemon's images_url, which distributes
+images along a tree instead of a swarm.
+
+PeerServer URLs:
+    /                   HTML listing of the images
+    /<filename>         an image or digest file, Range requests allowed
+    /.chunks/<filename> JSON status of an image: its size and either
+                        "complete" or the chunks held and being fetched
+'''
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from butter import vfs
+from cgi import escape
+from httplib import HTTPException
+from urllib import quote, unquote
+from urllib2 import HTTPError
+from urlparse import urlsplit
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+# Default port of the peer HTTP server
+PEER_PORT = 8151
+
+# Default size of the chunks images are exchanged in
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Seconds a peer's chunk status is reused before it is fetched again
+STATUS_TTL = 0.1
+
+# Chunks each download fetches from the source at the same time; more
+# would make peers fetch the same chunks before they see each other's
+SOURCE_WORKERS = 2
+
+# Seconds to wait for chunks that peers are fetching before fetching
+# them from the source, and to ignore a peer after an error
+PEER_TIMEOUT = 10
+
+CHUNKS_PREFIX = '/.chunks/'
+
+_RANGE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+_log = logging.getLogger(__name__)
+
+class ChunkMap(object):
+    '''
+    The chunks of a file that have been fetched or are being fetched.
+    '''
+    def __init__(self, size, chunk_size=CHUNK_SIZE, complete=False):
+        '''
+        Initialize the map of a file of size bytes.
+        '''
+        self.size = size
+        self.chunk_size = chunk_size
+        self.count = (size + chunk_size - 1) // chunk_size
+        self.have = set(range(self.count)) if complete else set()
+        self.pending = set()
+
+    def chunk_range(self, index):
+        '''
+        Return the (offset, length) of a chunk.
+
+        >>> ChunkMap(10, 4).chunk_range(2)
+        (8, 2)
+        '''
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.size - offset)
+
+    def covers(self, offset, length, chunks=None):
+        '''
+        Are all bytes of the range in the held (or the given) chunks?
+
+        >>> chunks = ChunkMap(10, 4)
+        >>> chunks.have.update([0, 1])
+        >>> chunks.covers(2, 6), chunks.covers(6, 4)
+        (True, False)
+        '''
+        chunks = self.have if chunks is None else chunks
+        if length <= 0:
+            return offset <= self.size
+        first = offset // self.chunk_size
+        last = (offset + length - 1) // self.chunk_size
+        return offset + length <= self.size and \
+               all(i in chunks for i in range(first, last + 1))
+
+    def is_complete(self):
+        '''
+        Are all chunks held?
+        '''
+        return len(self.have) == self.count
+
+    def to_json(self):
+        '''
+        Return the status reported to peers.
+        '''
+        if self.is_complete():
+            return {'size': self.size, 'complete': True}
+        return {'size': self.size, 'chunk_size': self.chunk_size,
+                'have': sorted(self.have), 'pending': sorted(self.pending)}
+
+    @staticmethod
+    def from_json(status):
+        '''
+        Parse the status of a peer.  Raises ValueError if it is bad.
+
+        >>> chunks = ChunkMap(10, 4)
+        >>> chunks.have.add(1)
+        >>> peer = ChunkMap.from_json(chunks.to_json())
+        >>> peer.have, peer.pending, peer.is_complete()
+        (set([1]), set([]), False)
+        >>> ChunkMap.from_json({'size': 10, 'complete': True}).covers(0, 10)
+        True
+        '''
+        try:
+            size = int(status['size'])
+            if status.get('complete'):
+                return ChunkMap(size, max(1, size), complete=True)
+            chunks = ChunkMap(size, int(status['chunk_size']))
+            chunks.have.update(int(i) for i in status['have'])
+            chunks.pending.update(int(i) for i in status['pending'])
+        except (KeyError, TypeError, AttributeError), ex:
+            raise ValueError('bad chunk status: {!r}'.format(ex))
+        if chunks.chunk_size < 1:
+            raise ValueError('bad chunk size: {}'.format(chunks.chunk_size))
+        return chunks
+
+class Swarm(object):
+    '''
+    Downloads images in chunks from peers and the source filesystem,
+    and keeps track of the downloads in progress for the PeerServer.
+    '''
+    def __init__(self, peers=None, chunk_size=CHUNK_SIZE, workers=4,
+                 read_bucket=None):
+        '''
+        Initialize the swarm.  See configure().
+        '''
+        self.lock = threading.Lock()
+        self.active = {}
+        self.configure(peers, chunk_size, workers, read_bucket)
+
+    def configure(self, peers=None, chunk_size=CHUNK_SIZE, workers=4,
+                  read_bucket=None):
+        '''
+        Set the peer URLs, the chunk size, and the number of chunks
+        each download fetches at the same time.  Reads from peers are
+        limited by read_bucket if it is given.
+        The peers may include this daemon's own PeerServer so every
+        daemon can share the same list.
+        '''
+        new_peers = []
+        for url in peers or []:
+            fs = vfs.get_filesystem(url)
+            fs.read_bucket = read_bucket
+            new_peers.append(fs)
+        self.peers = new_peers
+        self.chunk_size = chunk_size
+        self.workers = max(1, workers)
+
+    def download(self, src_fs, path, dest_fs, tmp_path, size,
+                 bufsize=1024*1024):
+        '''
+        Fetch the size bytes of the file at path on src_fs into
+        tmp_path on dest_fs, which is preallocated.  The chunks held so
+        far are served to peers until forget() is called.
+        Raises IOError or HTTPException if a chunk cannot be fetched
+        from src_fs.
+        Returns a (bytes from src_fs, bytes from peers) tuple.
+        '''
+        filename = os.path.basename(path)
+        with dest_fs.open(tmp_path, 'wb') as fp:
+            fp.truncate(size)
+        download = _Download(self, src_fs, path, dest_fs, tmp_path,
+                             ChunkMap(size, self.chunk_size), bufsize)
+        with self.lock:
+            self.active[filename] = download
+        download.run(self.workers)
+        return download.src_bytes, download.peer_bytes
+
+    def forget(self, filename):
+        '''
+        Stop serving the chunks of a download.
+        '''
+        with self.lock:
+            self.active.pop(filename, None)
+
+    def status(self, filename):
+        '''
+        Return the JSON status of a download in progress or None.
+        '''
+        with self.lock:
+            download = self.active.get(filename)
+        if download is None:
+            return None
+        with download.lock:
+            return download.chunks.to_json()
+
+    def partial(self, filename, offset, length):
+        '''
+        Return the (fs, path) of the download of filename if it holds
+        the whole range, otherwise None.
+        '''
+        with self.lock:
+            download = self.active.get(filename)
+        if download is None:
+            return None
+        with download.lock:
+            if not download.chunks.covers(offset, length):
+                return None
+        return download.dest_fs, download.tmp_path
+
+class _Download(object):
+    '''
+    A chunked download shared by the worker threads that run it.
+    '''
+    def __init__(self, swarm, src_fs, path, dest_fs, tmp_path, chunks,
+                 bufsize):
+        '''
+        '''
+        self.swarm = swarm
+        self.src_fs = src_fs
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.dest_fs = dest_fs
+        self.tmp_path = tmp_path
+        self.chunks = chunks
+        self.bufsize = bufsize
+        self.lock = threading.Lock()
+        self.status_lock = threading.Lock()
+        self.peer_status = {}
+        self.peer_errors = {}
+        self.src_fetching = 0
+        self.src_bytes = 0
+        self.peer_bytes = 0
+        self.error = None
+
+    def run(self, workers):
+        '''
+        Fetch all chunks using up to workers threads.
+        '''
+        threads = []
+        for unused_i in range(min(workers, self.chunks.count)):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def _work(self):
+        '''
+        Fetch missing chunks until there are none or a chunk cannot be
+        fetched from the source.  Runs in its own thread.
+        '''
+        waiting_since = None
+        while True:
+            statuses = self._peer_statuses()
+            with self.lock:
+                if self.error:
+                    return
+                missing = [i for i in range(self.chunks.count)
+                           if i not in self.chunks.have and
+                              i not in self.chunks.pending]
+                if not missing:
+                    # Other workers are fetching the last chunks
+                    return
+                index, peer = self._choose(missing, statuses,
+                                           waiting_since is not None and
+                                           time.time() - waiting_since >
+                                                PEER_TIMEOUT)
+                if index is not None:
+                    self.chunks.pending.add(index)
+                    if peer is None:
+                        self.src_fetching += 1
+            if index is None:
+                waiting_since = waiting_since or time.time()
+                time.sleep(STATUS_TTL)
+                continue
+            waiting_since = None
+            offset, length = self.chunks.chunk_range(index)
+            try:
+                self._fetch(peer, offset, length)
+            except:
+                with self.lock:
+                    self.chunks.pending.discard(index)
+                    if peer is None:
+                        self.src_fetching -= 1
+                        self.error = sys.exc_info()
+                        return
+                _log.warning('failed to fetch {} bytes {}-{} from peer {}: '
+                             '{}'.format(self.filename, offset,
+                                         offset + length - 1,
+                                         peer.abspath('/'),
+                                         sys.exc_info()[1]))
+                with self.status_lock:
+                    self.peer_errors[peer] = time.time()
+                    self.peer_status.pop(peer, None)
+                continue
+            with self.lock:
+                self.chunks.pending.discard(index)
+                self.chunks.have.add(index)
+                if peer is None:
+                    self.src_fetching -= 1
+                    self.src_bytes += length
+                else:
+                    self.peer_bytes += length
+
+    def _choose(self, missing, statuses, impatient):
+        '''
+        Choose a missing chunk and where to fetch it from: a random
+        chunk that a peer holds, else a random chunk that no peer holds
+        or is fetching, which is fetched from the source (peer None) if
+        fewer than SOURCE_WORKERS chunks are being fetched from it.
+        If impatient, chunks being fetched by peers are also fetched
+        from the source.  Returns (None, None) to wait for peers.
+        '''
+        claimed = [(status, status.have | status.pending)
+                   for status in statuses.itervalues()]
+        from_peers = []
+        from_src = []
+        for index in missing:
+            offset, length = self.chunks.chunk_range(index)
+            holders = [peer for peer, status in statuses.iteritems()
+                       if status.covers(offset, length)]
+            if holders:
+                from_peers.append((index, holders))
+            elif impatient or not any(status.covers(offset, length, chunks)
+                                      for status, chunks in claimed):
+                from_src.append(index)
+        if from_peers:
+            index, holders = random.choice(from_peers)
+            return index, random.choice(holders)
+        if from_src and self.src_fetching < SOURCE_WORKERS:
+            return random.choice(from_src), None
+        return None, None
+
+    def _peer_statuses(self):
+        '''
+        Return a dict mapping each peer that has (part of) the file to
+        its ChunkMap.  Statuses are fetched again after STATUS_TTL
+        seconds by whichever worker asks first.
+        '''
+        with self.status_lock:
+            now = time.time()
+            for peer in self.swarm.peers:
+                if now - self.peer_errors.get(peer, 0) < PEER_TIMEOUT:
+                    continue
+                fetched, unused_status = self.peer_status.get(peer,
+                                                              (0, None))
+                if now - fetched < STATUS_TTL:
+                    continue
+                try:
+                    with peer.open(CHUNKS_PREFIX + quote(self.filename),
+                                   'rb') as fp:
+                        status = ChunkMap.from_json(json.loads(fp.read()))
+                    if status.size != self.chunks.size:
+                        raise ValueError('size {} != {}'
+                                            .format(status.size,
+                                                    self.chunks.size))
+                except HTTPError, ex:
+                    status = None
+                    if ex.code != 404:
+                        self.peer_errors[peer] = now
+                except (EnvironmentError, HTTPException, ValueError), ex:
+                    _log.debug('ignore peer {}: {}'
+                                .format(peer.abspath('/'), ex))
+                    self.peer_errors[peer] = now
+                    status = None
+                self.peer_status[peer] = (now, status)
+            return dict((peer, status) for peer, (unused, status)
+                        in self.peer_status.iteritems()
+                        if status is not None and
+                           now - self.peer_errors.get(peer, 0) >=
+                                PEER_TIMEOUT)
+
+    def _fetch(self, peer, offset, length):
+        '''
+        Copy a byte range from a peer (or the source if peer is None)
+        to the same position in the temporary file.
+        '''
+        if peer is None:
+            src_fs, path = self.src_fs, self.path
+        else:
+            src_fs, path = peer, '/' + quote(self.filename)
+        with src_fs.open(path, 'rb', offset, length) as infp:
+            with self.dest_fs.open(self.tmp_path, 'r+b', offset) as outfp:
+                remaining = length
+                while remaining > 0:
+                    buf = infp.read(min(self.bufsize, remaining))
+                    if not buf:
+                        raise IOError('incomplete chunk of {} at byte {}: '
+                                      '{} bytes missing'
+                                        .format(src_fs.abspath(path),
+                                                offset, remaining))
+                    outfp.write(buf)
+                    remaining -= len(buf)
+
+class PeerServer(ThreadingMixIn, HTTPServer):
+    '''
+    Serves the images of a local filesystem and the chunks of a
+    Swarm's downloads in progress to peers.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, fs, swarm=None, port=PEER_PORT, address='127.0.0.1',
+                 bufsize=1024*1024):
+        '''
+        Bind the server to the port of address.  Requests are not
+        authenticated, so only bind to an address that untrusted hosts
+        cannot reach.  Raises socket.error if that fails.
+        '''
+        HTTPServer.__init__(self, (address, port), _PeerHandler)
+        self.fs = fs
+        self.swarm = swarm
+        self.address = address
+        self.port = self.server_address[1]
+        self.bufsize = bufsize
+        self.thread = None
+
+    def start(self):
+        '''
+        Serve requests in a background thread.
+        '''
+        _log.info('serving {} to peers on {}:{}'
+                    .format(self.fs.abspath('/'), self.address or '*',
+                            self.port))
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Stop serving and close the server socket.
+        '''
+        if self.thread:
+            self.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server_close()
+
+class _PeerHandler(BaseHTTPRequestHandler):
+    '''
+    Handle a peer request.  See the module docstring for the URLs.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        '''
+        Log requests with the logging module instead of to stderr.
+        '''
+        _log.debug('peer {}: {}'.format(self.client_address[0],
+                                        fmt % args))
+
+    def do_HEAD(self):
+        '''
+        '''
+        self._handle(False)
+
+    def do_GET(self):
+        '''
+        '''
+        self._handle(True)
+
+    def _handle(self, send_body):
+        '''
+        Dispatch a request on its path.
+        '''
+        path = unquote(urlsplit(self.path).path)
+        if path == '/':
+            self._send_listing(send_body)
+        elif path.startswith(CHUNKS_PREFIX):
+            self._send_status(path[len(CHUNKS_PREFIX):], send_body)
+        else:
+            self._send_file(path[1:], send_body)
+
+    def _send_listing(self, send_body):
+        '''
+        Send an HTML page that links to each file, except hidden files.
+        '''
+        links = ['<a href="{0}">{1}</a><br>'.format(quote(name),
+                                                    escape(name))
+                 for name in sorted(self.server.fs.list('/'))
+                 if not name.startswith('.') and not name.endswith('/')]
+        body = '<html><body>\n{}\n</body></html>\n'.format('\n'.join(links))
+        self._send_data(200, 'text/html', body, send_body)
+
+    def _send_status(self, filename, send_body):
+        '''
+        Send the chunk status of a file.
+        '''
+        status = None
+        if _is_servable(filename):
+            size = self._size(filename)
+            if size is not None:
+                status = {'size': size, 'complete': True}
+            elif self.server.swarm:
+                status = self.server.swarm.status(filename)
+        if status is None:
+            self.send_error(404)
+            return
+        self._send_data(200, 'application/json', json.dumps(status),
+                        send_body)
+
+    def _send_file(self, filename, send_body):
+        '''
+        Send all or the requested range of a file.  The ranges of a
+        download in progress are only sent once they have been fetched.
+        '''
+        if not _is_servable(filename):
+            self.send_error(404)
+            return
+        fs, path = self.server.fs, '/' + filename
+        size = self._size(filename)
+        byte_range = _parse_range(self.headers.getheader('Range'),
+                                  size if size is not None else sys.maxint)
+        if size is None:
+            download = None
+            if byte_range and self.server.swarm:
+                download = self.server.swarm.partial(filename, *byte_range)
+            if download is None:
+                self.send_error(404)
+                return
+            fs, path = download
+        if byte_range == ():
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{}'.format(size))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        try:
+            fp = fs.open(path, 'rb', byte_range[0] if byte_range else 0)
+        except (OSError, IOError):
+            self.send_error(404)
+            return
+        with fp:
+            if byte_range:
+                offset, length = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                        offset, offset + length - 1,
+                        size if size is not None else '*'))
+            else:
+                offset, length = 0, size
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(length))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            if not send_body:
+                return
+            remaining = length
+            while remaining > 0:
+                buf = fp.read(min(self.server.bufsize, remaining))
+                if not buf:
+                    # The client sees the short body; close the connection
+                    self.close_connection = 1
+                    break
+                self.wfile.write(buf)
+                remaining -= len(buf)
+
+    def _send_data(self, code, content_type, body, send_body):
+        '''
+        Send a small response.
+        '''
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _size(self, filename):
+        '''
+        Return the size of a complete local file or None.
+        '''
+        try:
+            return self.server.fs.size('/' + filename)
+        except (vfs.NoSuchFileError, OSError):
+            return None
+
+def _is_servable(filename):
+    '''
+    Only visible top-level files are served.
+
+    >>> _is_servable('arch_20120101.raw'), _is_servable('.digests')
+    (True, False)
+    >>> _is_servable('../etc/passwd')
+    False
+    '''
+    return bool(filename) and '/' not in filename and \
+           not filename.startswith('.')
+
+def _parse_range(header, size):
+    '''
+    Parse a Range header into (offset, length).  Returns None if there
+    is no usable header and () if the range is beyond the end of the
+    file.
+
+    >>> _parse_range('bytes=0-9', 100), _parse_range('bytes=90-', 100)
+    ((0, 10), (90, 10))
+    >>> _parse_range('bytes=100-', 100), _parse_range('pages=1-2', 100)
+    ((), None)
+    '''
+    match = _RANGE.match(header or '')
+    if not match:
+        return None
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else size - 1
+    if start >= size:
+        return ()
+    if end < start:
+        return None
+    return start, min(end, size - 1) - start + 1
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+'''
+Choose how long vmcache sleeps between polls of images_url.
+
+A new image version often comes with others, e.g. a release of several
+images, so the interval drops to its minimum as soon as the remote
+images change.  While they stay the same the interval doubles up to its
+maximum.  Each interval is randomly stretched or shrunk by up to the
+jitter fraction so a fleet of vmcache daemons doesn't poll the mirror
+at the same moment.
+'''
+
+import random
+
+class PollScheduler(object):
+    '''
+    Adaptive poll intervals, in seconds.
+
+    >>> sched = PollScheduler(60, 10, 300)
+    >>> [sched.next_interval('v1') for unused_i in range(5)]
+    [60.0, 120.0, 240.0, 300.0, 300.0]
+    >>> sched.next_interval('v2'), sched.next_interval('v2')
+    (10.0, 20.0)
+    '''
+    def __init__(self, interval, min_interval=None, max_interval=None,
+                 jitter=0.0, backoff=2.0):
+        '''
+        Initialize the scheduler.  See configure().
+        '''
+        self.state = None
+        self.configure(interval, min_interval, max_interval, jitter, backoff)
+
+    def configure(self, interval, min_interval=None, max_interval=None,
+                  jitter=0.0, backoff=2.0):
+        '''
+        Set the starting interval, the bounds of the interval (both
+        default to the starting interval, i.e. a fixed interval), the
+        jitter fraction, and the factor by which the interval grows
+        while nothing changes.  The next interval is the starting one.
+        '''
+        self.min_interval = float(min(interval, min_interval or interval))
+        self.max_interval = float(max(interval, max_interval or interval))
+        self.jitter = jitter
+        self.backoff = backoff
+        self.interval = float(interval)
+        self.started = False
+
+    def next_interval(self, state):
+        '''
+        Return the seconds until the next poll.  state is any value
+        that changes when the remote images do, e.g. a frozenset of
+        their ids.
+        '''
+        if not self.started:
+            self.started = True
+        elif state != self.state:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff,
+                                self.max_interval)
+        self.state = state
+        if not self.jitter:
+            return self.interval
+        return self.interval * random.uniform(1 - self.jitter,
+                                              1 + self.jitter)
@@ -4,8 +4,18 @@
 '''
 from butter.daemon import Daemon
 from butter.vmcache import image
+from butter.vmcache import metrics
+from butter.vmcache.decompress import decompressed_path
+from butter.vmcache.hooks import HookRunner
+from butter.vmcache.index import LocalIndex
+from butter.vmcache.metrics import MetricsServer
+from butter.vmcache.peer import PeerServer, Swarm
+from butter.vmcache.schedule import PollScheduler
+import Queue
 import logging
 import os
+import socket
+import threading
 import time
 
 _log = logging.getLogger(__name__)
@@ -18,11 +28,112 @@ class VmCacheDaemon(Daemon):
         '''
         Daemon.__init__(self, 'vmcache')
         self.config = config
+        self.local_index = None
+        self.swarm = None
+        self.peer_server = None
+        self.metrics_servers = []
+        self.hooks = HookRunner()
+        self.scheduler = None
 
     def configure(self):
         '''
         '''
-        return self.config.load()
+        if not self.config.load():
+            return False
+        cfg = self.config
+        intervals = (cfg.interval_secs, cfg.min_interval_secs,
+                     cfg.max_interval_secs, cfg['poll_jitter'])
+        if self.scheduler is None:
+            self.scheduler = PollScheduler(*intervals)
+        else:
+            self.scheduler.configure(*intervals)
+        # images_dir or image_regex may have changed
+        if self.local_index:
+            self.local_index.close()
+            self.local_index = None
+        self._configure_peers()
+        self._configure_metrics()
+        return True
+
+    def _configure_peers(self):
+        '''
+        Apply the peer config values.  The swarm is kept so downloads
+        in progress stay visible to the peer server.  The peer server
+        is stopped if its address, port or directory changed and is
+        (re)started by run(), i.e. after the daemon has detached.
+        '''
+        cfg = self.config
+        port = cfg['peer_port']
+        if port or cfg['peers']:
+            if self.swarm is None:
+                self.swarm = Swarm()
+            self.swarm.configure(cfg['peers'], cfg['peer_chunk_size'],
+                                 cfg['peer_workers'], cfg.download_bucket)
+        else:
+            self.swarm = None
+        server = self.peer_server
+        if server and (server.port != port or
+                       server.address != cfg['peer_address'] or
+                       server.fs.abspath('/') != cfg.local_fs.abspath('/')):
+            server.stop()
+            self.peer_server = None
+
+    def _start_peer_server(self):
+        '''
+        Start serving images to peers if peer_port is set.
+        '''
+        port = self.config['peer_port']
+        if not port or self.peer_server:
+            return
+        try:
+            self.peer_server = PeerServer(self.config.local_fs, self.swarm,
+                                          port, self.config['peer_address'],
+                                          bufsize=self.config.buffer_size)
+        except socket.error, ex:
+            _log.error('cannot serve peers on {}:{}: {}'
+                        .format(self.config['peer_address'], port, ex))
+            return
+        self.peer_server.start()
+
+    def _configure_metrics(self):
+        '''
+        Stop the metrics servers if their port or socket changed.  They
+        are (re)started by run().
+        '''
+        if self.metrics_servers and \
+           [(server.port, server.path) for server in self.metrics_servers] \
+                != self._metrics_addresses():
+            for server in self.metrics_servers:
+                server.stop()
+            self.metrics_servers = []
+
+    def _metrics_addresses(self):
+        '''
+        Return the configured (port, socket path) pairs to serve
+        metrics on.
+        '''
+        addresses = []
+        if self.config['metrics_port']:
+            addresses.append((self.config['metrics_port'], None))
+        if self.config['metrics_socket']:
+            addresses.append((None, self.config['metrics_socket']))
+        return addresses
+
+    def _start_metrics_servers(self):
+        '''
+        Start serving metrics if metrics_port or metrics_socket is set.
+        '''
+        if self.metrics_servers:
+            return
+        for port, path in self._metrics_addresses():
+            try:
+                server = MetricsServer(port or 0, path=path)
+            except socket.error, ex:
+                _log.error('cannot serve metrics on {}: {}'
+                            .format(path or 'port {}'.format(port), ex))
+                continue
+            server.start()
+            self.metrics_servers.append(server)
 
     def run(self):
         '''
@@ -31,10 +142,18 @@ class VmCacheDaemon(Daemon):
             if self.reconfigure:
                 self.configure()
                 self.reconfigure = False
+            self._start_peer_server()
+            self._start_metrics_servers()
+            # A trigger from now on asks for another sync
+            self.trigger = False
+            start = time.time()
             remote = image.Images(self.config.remote_fs,
                                   self.config.regex)
-            local = image.Images(self.config.local_fs,
-                                 self.config.regex)
+            metrics.observe('vmcache_remote_scan_seconds',
+                            time.time() - start)
+            start = time.time()
+            local = self._local_images()
+            metrics.observe('vmcache_local_scan_seconds', time.time() - start)
             if _log.isEnabledFor(logging.DEBUG):
                 rimgs = sorted(remote.keys())
                 _log.debug('remote images: {}'.format(
@@ -43,59 +162,208 @@ class VmCacheDaemon(Daemon):
                 _log.debug('local images: {}'.format(
                            ', '.join(limgs) if limgs else '<none>'))
 
-            for name in sorted(remote.names()):
-                # Latest remote image
-                latest_remote = remote.latest(name)
-                _log.debug('latest remote {} image: {}'
-                            .format(name, latest_remote.fs.abspath(
-                                        latest_remote.image_path)))
-                # Latest local image
-                latest_local = local.latest(name)
-                if latest_local:
-                    _log.debug('latest local {} image: {}'
-                                .format(name, latest_local.fs.abspath(
-                                            latest_local.image_path)))
-                else:
-                    _log.debug('no local {} image'.format(name))
-
-                # If local isn't up-to-date, download the remote image
-                if latest_local is None or latest_remote > latest_local:
-                    _log.info('update {} image to {}'
-                                .format(latest_remote.name,
-                                        latest_remote.img_id))
-                    img = latest_remote.download(self.config.local_fs)
-                    if img:
-                        local[img.img_id] = img
-                        if self.config.after_download_commands:
-                            imgpath = img.fs.abspath(img.image_path)
-                            digestpath = img.fs.abspath(img.digest_path)
-                            attrs = {
-                                'image_path':      imgpath,
-                                'image_filename':  os.path.basename(imgpath),
-                                'digest_path':     digestpath,
-                                'digest_filename': os.path.basename(digestpath)
-                                }
-                            for cmd in self.config.after_download_commands:
-                                cmd = cmd.format(**attrs)
-                                _log.info('run: {}'.format(cmd))
-                                rc = os.system(cmd)
-                                _log.info('exit={}'.format(rc))
-                                if rc != 0:
-                                    _log.error('abort after_download processing')
-                                    break
-                else:
-                    _log.debug('local {} image is up-to-date: {}'
-                                .format(latest_local.name, latest_local))
-
-                # Prune old images
-                images = local.images(name)
-                for img in images[:-self.config.keep]:
-                    local.delete(img.img_id)
-
-            # Sleep for the poll interval.  We will be awakened if a
+            if self._sync_all(remote, local):
+                metrics.gauge('vmcache_last_sync_timestamp_seconds',
+                              time.time())
+            metrics.gauge('vmcache_last_poll_timestamp_seconds', time.time())
+            if self.config.object_store:
+                freed = self.config.object_store.gc()
+                if freed:
+                    _log.info('freed {} bytes of unreferenced objects'
+                                .format(freed))
+            if self.config.digest_cache:
+                # Forget the digests of images that were pruned or replaced
+                for img in local.values():
+                    self.config.digest_cache.keep(img.image_path,
+                                                  img.digest_type,
+                                                  img.image_stat)
+                self.config.digest_cache.save(prune=True)
+
+            # Sleep until the next poll.  We will be awakened if a
             # signal is sent to us, e.g. SIGHUP that will cause us to
-            # reread the config file.
+            # reread the config file or SIGUSR1 to sync now.
+            secs = self.scheduler.next_interval(frozenset(remote.keys()))
             now = time.time()
-            _log.debug('sleep {} seconds'.format(self.config.interval_secs))
-            time.sleep(self.config.interval_secs)
-            _log.debug('slept {} seconds'.format(time.time()-now))
+            _log.debug('sleep {:.0f} seconds'.format(secs))
+            if not self.sleep(secs) and self.trigger:
+                _log.info('sync requested')
+            _log.debug('slept {:.0f} seconds'.format(time.time()-now))
+        self.hooks.stop(self.config.hook_timeout_secs)
+        for server in self.metrics_servers:
+            server.stop()
+
+    def _local_images(self):
+        '''
+        Return the local images.  Unless watch_images_dir is disabled,
+        they come from an inotify-maintained index that is created on
+        first use, i.e. after the daemon has closed its inherited files.
+        '''
+        if not self.config['watch_images_dir']:
+            return image.Images(self.config.local_fs, self.config.regex)
+        if self.local_index is None:
+            self.local_index = LocalIndex(self.config.local_fs,
+                                          self.config.regex)
+        return self.local_index.images()
+
+    def _sync_all(self, remote, local):
+        '''
+        Bring the local images up-to-date with the remote images.
+        Up to max_parallel_downloads image names are synced at the same
+        time in worker threads while the main thread handles SIGHUP: a
+        new download_rate or write_rate applies to running downloads
+        right away, while the rest of the new config is only loaded by
+        run() once the workers have finished, so that a sync never
+        mixes old and new settings.
+        No new image names are started once shutdown is set, but syncs
+        that are already running are allowed to finish.
+        Returns True if every image name was synced without errors.
+        '''
+        names = Queue.Queue()
+        for name in sorted(remote.names()):
+            names.put(name)
+        lock = threading.Lock()
+        failed = []
+        nthreads = min(self.config.max_parallel_downloads, names.qsize())
+        threads = []
+        reconfigure = False
+        for unused_i in range(nthreads):
+            thread = threading.Thread(target=self._sync_worker,
+                                      args=(names, remote, local, lock,
+                                            failed))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # Join with a timeout so the main thread still handles signals
+            while thread.is_alive():
+                thread.join(1)
+                if self.reconfigure:
+                    self.config.load_rates()
+                    self.reconfigure = False
+                    reconfigure = True
+        # Leave the full reload to run()
+        self.reconfigure = self.reconfigure or reconfigure
+        self._log_throttle()
+        return not failed and names.empty()
+
+    def _log_throttle(self):
+        '''
+        Log and reset the throttling counters.
+        '''
+        for what, bucket in [('download', self.config.download_bucket),
+                             ('write', self.config.write_bucket)]:
+            nbytes, wait_secs = bucket.counters(reset=True)
+            metrics.inc('vmcache_{}_bytes_total'.format(what), nbytes)
+            rate = bucket.rate()
+            if nbytes and (rate or wait_secs):
+                _log.info('{} throttle: {} bytes, {:.1f} secs throttled, '
+                          'current limit {}'
+                            .format(what, nbytes, wait_secs,
+                                    '{} bytes/sec'.format(rate) if rate
+                                    else 'none'))
+
+    def _sync_worker(self, names, remote, local, lock, failed):
+        '''
+        Sync image names from the queue until it is empty or the daemon
+        is shutting down.  The names that fail to sync are appended to
+        failed.
+        '''
+        while not self.shutdown:
+            try:
+                name = names.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                if not self._sync(name, remote, local, lock):
+                    failed.append(name)
+            except Exception:
+                _log.error('failed to sync {} image'.format(name),
+                           exc_info=True)
+                failed.append(name)
+
+    def _sync(self, name, remote, local, lock):
+        '''
+        Download the latest remote image with the given name if the
+        local image is out-of-date, then prune old local images.
+        The lock guards the local images dictionary which is shared by
+        all sync threads.
+        Returns True if the local image is up-to-date afterwards.
+        '''
+        # Latest remote image
+        latest_remote = remote.latest(name)
+        _log.debug('latest remote {} image: {}'
+                    .format(name, latest_remote.fs.abspath(
+                                latest_remote.image_path)))
+        # Latest local image
+        with lock:
+            latest_local = local.latest(name)
+        if latest_local:
+            _log.debug('latest local {} image: {}'
+                        .format(name, latest_local.fs.abspath(
+                                    latest_local.image_path)))
+        else:
+            _log.debug('no local {} image'.format(name))
+
+        # If local isn't up-to-date, download the remote image
+        if latest_local is None or latest_remote > latest_local:
+            _log.info('update {} image to {}'
+                        .format(latest_remote.name,
+                                latest_remote.img_id))
+            delta_base = latest_local if self.config['delta_updates'] \
+                                      else None
+            start = time.time()
+            img = latest_remote.download(
+                    self.config.local_fs,
+                    bufsize=self.config.buffer_size,
+                    segments=self.config.download_segments,
+                    min_segment_size=self.config.min_segment_size,
+                    digest_cache=self.config.digest_cache,
+                    decompress=self.config['decompress'],
+                    decompress_threads=self.config['decompress_threads'],
+                    delta_base=delta_base,
+                    swarm=self.swarm,
+                    store=self.config.object_store)
+            elapsed = time.time() - start
+            metrics.observe('vmcache_download_seconds', elapsed, name=name)
+            metrics.inc('vmcache_downloads_total', name=name,
+                        result='ok' if img else 'failed')
+            if img:
+                if elapsed:
+                    size = img.fs.stat(img.image_path).st_size
+                    metrics.gauge('vmcache_download_bytes_per_second',
+                                  size / elapsed, name=name)
+                with lock:
+                    local[img.img_id] = img
+                if self.config.after_download_hooks:
+                    imgpath = img.fs.abspath(img.image_path)
+                    digestpath = img.fs.abspath(img.digest_path)
+                    attrs = {
+                        'image_path':      imgpath,
+                        'image_filename':  os.path.basename(imgpath),
+                        'digest_path':     digestpath,
+                        'digest_filename': os.path.basename(digestpath)
+                        }
+                    rawpath = decompressed_path(imgpath)
+                    # Decompression may have failed without failing the
+                    # download
+                    if self.config['decompress'] and rawpath and \
+                       os.path.exists(rawpath):
+                        attrs['raw_path'] = rawpath
+                        attrs['raw_filename'] = os.path.basename(rawpath)
+                    # Hooks run in the background; don't wait for them
+                    self.hooks.run(self.config.after_download_hooks, attrs,
+                                   img.img_id)
+        else:
+            _log.debug('local {} image is up-to-date: {}'
+                        .format(latest_local.name, latest_local))
+
+        # Prune old images
+        with lock:
+            images = local.images(name)
+            for img in images[:-self.config.keep]:
+                local.delete(img.img_id)
+            latest_local = local.latest(name)
+        behind = [img for img in remote.images(name)
+                  if latest_local is None or img > latest_local]
+        metrics.gauge('vmcache_images_behind', len(behind), name=name)
+        return latest_local is not None and not behind
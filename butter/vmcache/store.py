@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+'''
+A content-addressed store of the images in images_dir.
+
+The same image often appears under several names or versions, e.g. a
+re-tagged release.  ObjectStore keeps one hardlink to each distinct
+image under its digest in a hidden directory, /.objects/<algorithm>/
+<digest>, and the image files in images_dir are hardlinks to these
+objects.  A new image whose digest is already in the store is linked
+instead of downloaded, and the data of an image is only freed when its
+last name is pruned and gc() removes the unreferenced object.
+
+All names of an object share its inode, so an image file that is
+modified in place changes every other name and the object too.  Only
+the downloaded images are stored, not the decompressed raw images that
+are meant to be opened and written, and stored objects are verified
+before they are linked to new names (see verify()).
+'''
+
+import errno
+import logging
+import os
+
+_log = logging.getLogger(__name__)
+
+class ObjectStore(object):
+    '''
+    Image objects on a local filesystem, keyed by digest.
+    '''
+    def __init__(self, fs, path='/.objects'):
+        '''
+        Initialize the store in the path directory of fs.
+        '''
+        self.fs = fs
+        self.path = path
+
+    def object_path(self, algorithm, digest):
+        '''
+        Return the path of an object.
+
+        >>> ObjectStore(None).object_path('sha256', 'ab12')
+        '/.objects/sha256/ab12'
+        '''
+        return '{}/{}/{}'.format(self.path, algorithm, digest)
+
+    def lookup(self, algorithm, digest):
+        '''
+        Return the path of an object or None if it isn't stored.
+        '''
+        if not digest or '/' in digest or not algorithm:
+            return None
+        path = self.object_path(algorithm, digest)
+        try:
+            self.fs.stat(path)
+        except OSError, ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return None
+        return path
+
+    def add(self, path, algorithm, digest):
+        '''
+        Store the verified file at path under its digest.  If the store
+        already has the object, path is replaced by a link to it.
+        Errors (e.g. a filesystem without hardlinks) are logged and the
+        file is left as it is.
+        Returns True if path is now a link to an object that was
+        already stored.
+        '''
+        obj = self.object_path(algorithm, digest)
+        try:
+            if self.lookup(algorithm, digest):
+                if _same_file(self.fs.stat(path), self.fs.stat(obj)):
+                    return False
+                tmp = path + '.link'
+                self.fs.remove(tmp)
+                self.fs.link(obj, tmp)
+                self.fs.rename(tmp, path)
+                _log.info('{} has the same contents as {}, linked'
+                            .format(self.fs.abspath(path),
+                                    self.fs.abspath(obj)))
+                return True
+            parent = os.path.dirname(self.fs.abspath(obj))
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            self.fs.link(path, obj)
+            _log.debug('stored {} as {}'.format(self.fs.abspath(path),
+                                                self.fs.abspath(obj)))
+        except OSError, ex:
+            _log.warning('cannot store {} in {}: {}'
+                            .format(self.fs.abspath(path),
+                                    self.fs.abspath(self.path), ex))
+        return False
+
+    def link(self, obj, path):
+        '''
+        Link the object to path, replacing any file at path.
+        '''
+        self.fs.remove(path)
+        self.fs.link(obj, path)
+
+    def gc(self):
+        '''
+        Remove the objects that no image file links to any more.
+        Returns the number of bytes freed.
+        '''
+        freed = 0
+        for unused_root, unused_dirs, files in self.fs.walk_stat(self.path):
+            for info in files:
+                try:
+                    st = info.stat()
+                except OSError, ex:
+                    if ex.errno != errno.ENOENT:
+                        raise
+                    continue
+                if st.st_nlink == 1:
+                    _log.info('delete unreferenced object {}'
+                                .format(info.abspath))
+                    self.fs.remove(info.path)
+                    freed += st.st_size
+        return freed
+
+def _same_file(st1, st2):
+    '''
+    Are the stat results of the same file?
+    '''
+    return st1.st_dev == st2.st_dev and st1.st_ino == st2.st_ino